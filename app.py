@@ -6,19 +6,30 @@ patterns in bird sightings and air quality in Oregon.
 # Run this app with `python app.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
 
-from urllib.request import urlopen
-import json
+import calendar
+import os
 
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html, Patch
 from dash.dependencies import Input, Output, State
 import pandas as pd
+import plotly
 import plotly.express as px
-
-from flask_caching import Cache
-
-from phoenix.code.appfunctions import subset_date, subset_air_quality
+import plotly.graph_objects as go
+
+from phoenix.code import appfunctions
+from phoenix.code.appfunctions import (county_day_values, season_values,
+                                       build_date_index, build_query_index,
+                                       query_orders, query_rows,
+                                       build_count_cube,
+                                       county_counts,
+                                       severe_aq_intervals, county_intervals)
+from phoenix.code.column_store import (read_table, load_store,
+                                       build_shared_store, SCHEMAS)
+from phoenix.code.county_geometry import (fetch_county_geojson,
+                                          load_county_map)
+from phoenix.code.tiered_cache import (tiered_memoize, popular_requests,
+                                       file_version)
 
 # Initialize Dash App
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -32,23 +43,43 @@ colors = {
     'text': '#000000'
 }
 
-# Initialize Cache
-CACHE_CONFIG = {
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': 'cache',
-    'CACHE_DEFAULT_TIMEOUT': 180
-}
-
-cache = Cache(app.server, config=CACHE_CONFIG)
+# Initialize Cache: an in-process LRU tier of CACHE_SIZE results in
+# front of a directory shared by all workers. Cached figures are keyed
+# by the data, the code drawing them and the plotly version, so a
+# deploy never serves figures pickled by older code
+CACHE_DIR = os.environ.get('PHOENIX_CACHE_DIR', 'cache')
+CACHE_SIZE = 512
+data_version = file_version(['phoenix/data/OR_DailyAQ_byCounty.csv',
+                             'phoenix/data/ebird_app_data.csv'])
+code_version = file_version([__file__, appfunctions.__file__])
+cache_version = f'{data_version}-{code_version}-plotly{plotly.__version__}'
 
 # Read in and clean data
 months = [6, 7, 8, 9]
 
+# Directory of the shared dataset stores. When set, the cleaned and
+# sorted datasets and the row orders of the query index are built there
+# once, and every worker memory-maps them read-only, so the data is held
+# in memory once per machine rather than once per worker
+SHARED_DATA_DIR = os.environ.get('PHOENIX_SHARED_DATA')
+
+# Columns the sightings callbacks filter on, the only ones indexed
+BIRD_FILTERS = ['common name']
+
+# Zoom level the maps open at, which decides the county geometry served
+MAP_ZOOM = 5
+
+# Milliseconds each day is shown for during playback
+PLAY_INTERVAL = 700
+
 
-@cache.cached(key_prefix='county_map')
 def get_county_map():
     """
-    Fetches the Oregon County geojson file for mapping
+    Loads the Oregon County geojson file for mapping, at the lightest
+    simplification that still looks right at the map's zoom level.
+    The full resolution map is only downloaded from the repo, and its
+    simplified levels built, when there is no local copy yet; workers
+    starting together download it once.
 
     Args: None
 
@@ -56,15 +87,17 @@ def get_county_map():
         counties1 (geojson): Oregon county map file from repo
     """
     print("Retrieving Oregon County Map...")
-    with urlopen('https://raw.githubusercontent.com/emilysellinger/Phoenix/main/phoenix/data/Oregon_counties_map.geojson') as response:# noqa
-        counties1 = json.load(response)
+    fetch_county_geojson('https://raw.githubusercontent.com/emilysellinger/Phoenix/main/phoenix/data/Oregon_counties_map.geojson')
+
+    counties1 = load_county_map(MAP_ZOOM)
     return counties1
 
 
 counties = get_county_map()
+county_order = [feature['properties']['altname']
+                for feature in counties['features']]
 
 
-@cache.cached(key_prefix='aq_data')
 def get_aq_data():
     """
     Fetches the Oregon air quality data and filters data based on
@@ -77,19 +110,44 @@ def get_aq_data():
     """
     print("Retrieving Air Quality County Data...")
 
-    aq1 = pd.read_csv('phoenix/data/OR_DailyAQ_byCounty.csv')
+    aq1 = read_table('phoenix/data/OR_DailyAQ_byCounty.csv',
+                     SCHEMAS['county_aq'])
 
-    aq1['Date'] = pd.to_datetime(aq1['Date'])
     aq1 = aq1.loc[aq1['Date'].dt.month.isin(months)]
     aq1 = aq1[aq1['Avg_PM2.5'].notna()]
 
     return aq1
 
 
-aq = get_aq_data()
+def shared_data(name, schema, prepare):
+    """
+    Builds a dataset into the shared stores unless another worker has
+    already built it from the current data, and returns its store path.
+
+    Args:
+        name (str): name of the dataset's store
+        schema (dict): dtype of each column of the store
+        prepare (function): returns the prepared dataset
+
+    Returns:
+        store_path (str): store to memory-map the dataset from
+    """
+    store_path = os.path.join(SHARED_DATA_DIR, name + '.store')
+    build_shared_store(store_path, schema, prepare, data_version)
+    return store_path
+
+
+if SHARED_DATA_DIR:
+    aq_store = shared_data(
+        'county_aq', SCHEMAS['county_aq'],
+        lambda: build_date_index(get_aq_data(), 'Date')[0])
+    aq = load_store(aq_store)
+else:
+    aq = get_aq_data()
+aq, aq_dates = build_date_index(aq, 'Date')
+aq_intervals = severe_aq_intervals(aq)
 
 
-@cache.cached(key_prefix='bird_data')
 def get_bird_data():
     """
     Fetches the full Oregon eBird dataset and filters data based on
@@ -102,14 +160,45 @@ def get_bird_data():
     """
 
     print("Retrieving Bird Data...")
-    bird1 = pd.read_csv("phoenix/data/ebird_app_data.csv")
-    bird1['observation date'] = pd.to_datetime(bird1['observation date'])
+    bird1 = read_table("phoenix/data/ebird_app_data.csv", SCHEMAS['ebird'])
     bird1 = bird1.loc[bird1['observation date'].dt.month.isin(months)]
 
     return bird1
 
 
-bird = get_bird_data()
+def prepare_bird_data():
+    """
+    Sorts the eBird data by date and appends the row order of each
+    filter column, for storing in the shared stores.
+
+    Args: None
+
+    Returns:
+        bird1 (pd dataframe): sorted eBird data with an 'order:' column
+            per filter column
+    """
+    bird1 = build_date_index(get_bird_data(), 'observation date')[0]
+    orders = query_orders(bird1, BIRD_FILTERS)
+    return bird1.assign(**{'order:' + column: order
+                           for column, order in orders.items()})
+
+
+if SHARED_DATA_DIR:
+    order_columns = ['order:' + column for column in BIRD_FILTERS]
+    bird_store = shared_data(
+        'ebird', {**SCHEMAS['ebird'],
+                  **{column: 'int32' for column in order_columns}},
+        prepare_bird_data)
+    bird = load_store(bird_store, columns=list(SCHEMAS['ebird']))
+    bird_orders = load_store(bird_store, columns=order_columns)
+    bird_orders = {column: bird_orders['order:' + column].to_numpy()
+                   for column in BIRD_FILTERS}
+else:
+    bird = get_bird_data()
+    bird_orders = None
+bird, bird_dates = build_date_index(bird, 'observation date')
+bird_query = build_query_index(bird, BIRD_FILTERS, bird_dates, bird_orders)
+bird_cube = build_count_cube(bird, ['common name', 'family', 'order'])
 
 # Get categories for dropdowns
 category_labels = pd.read_csv("phoenix/data/category_labels.csv")
@@ -119,6 +208,44 @@ county_names = category_labels['county'].unique()
 family_names = category_labels['family'].unique()
 full_months = ['June', 'July', 'August', 'September']
 
+
+def base_map(month, day):
+    """
+    Creates the parts of the air quality map that do not change with the
+    date: the county geometry, color scale and layout, and an empty trace
+    for bird sightings. Callbacks only patch the county values and the
+    sightings, so the geometry is sent to the browser once.
+
+    Args:
+        month (str): month the map opens at
+        day (int): day the map opens at
+
+    Returns:
+        aq_map (figure): map with a choropleth trace and a scatter trace
+    """
+    choropleth = go.Choroplethmapbox(
+        geojson=counties, featureidkey='properties.altname',
+        locations=county_order,
+        z=county_day_values(aq, aq_dates, county_order, month, day),
+        text=county_order, zmin=0, zmax=300,
+        colorscale=px.colors.sequential.Turbo, marker_opacity=0.5,
+        colorbar={'title': {'text': 'Average PM 2.5'}},
+        hovertemplate='<b>%{text}</b><br>Average PM 2.5=%{z}<extra></extra>')
+    sightings = go.Scattermapbox(
+        lat=[], lon=[], mode='markers',
+        marker={'color': '#EF553B', 'size': [], 'sizemode': 'area'},
+        hovertemplate='observation count=%{marker.size}<extra></extra>')
+
+    aq_map = go.Figure([choropleth, sightings])
+    aq_map.update_layout(
+        mapbox_style='carto-positron', mapbox_zoom=MAP_ZOOM,
+        mapbox_center={"lat": 44.14495826303137, "lon": -120.60278690370761},
+        margin={'t': 0, 'b': 0, 'l': 0, 'r': 0}, showlegend=False,
+        uirevision='aq-map')
+
+    return aq_map
+
+
 # Configure the style and layout of the app (including headings etc)
 app.layout = html.Div(
     style={'backgroundColor': colors['background']},
@@ -170,7 +297,16 @@ app.layout = html.Div(
                     min=1,
                     value=1,
                     step=1),
-                html.Div(id='slider-output-container')
+                html.Div(id='slider-output-container'),
+                html.Button('Play', id='play-button', n_clicks=0),
+                dcc.Interval(id='play-interval', interval=PLAY_INTERVAL,
+                             disabled=True),
+                # County PM 2.5 of the whole season, for changing days in
+                # the browser, and the date of the bird sightings shown
+                dcc.Store(id='season-aq',
+                          data=season_values(aq, aq_dates, county_order)),
+                dcc.Store(id='sightings-date',
+                          data={'month': 'September', 'day': 1})
             ], className="four columns"),
 
             html.Div([
@@ -208,6 +344,7 @@ app.layout = html.Div(
             html.Div([
                 dcc.Graph(
                     id='aq-map',
+                    figure=base_map('September', 1),
                     style={'width': '90vh', 'height': '60vh'}),
                 html.Div(id='graph-output',
                          style={'margin-left': 20, 'backgroundColor': colors['background'],
@@ -229,100 +366,165 @@ app.layout = html.Div(
 @app.callback(
     Output('aq-map', 'figure'),
     Input('species', 'value'),
-    Input('month', 'value'),
-    Input('day-slider', 'value'))
-@cache.memoize(timeout=360)
-def update_aq_graph(species, month, day_slider):
+    Input('sightings-date', 'data'),
+    State('play-interval', 'disabled'))
+def update_aq_graph(species, sightings_date, paused):
     """
-    Creates an air quality choropleth map depending on the species,
+    Updates the air quality choropleth map depending on the species,
     month, and day selected in the app. Bird sightings for selected
     species are plotted as a scatter plot over air quality choropleth.
+    Only the county values and the sightings are sent to the browser.
+    During playback the browser colors the counties from the season
+    data and hides the sightings, so nothing is sent until it pauses.
     Args:
         species(str): common name selected from dropdown
-        month(str): name of month selected from dropdown
-        day_slider(int): day value from slider
+        sightings_date(dict): month name and day selected, updated
+            whenever playback is not running
+        paused(bool): whether playback is not running
     Returns:
-        Air Quality Choropleth map with bird sightings overlayed
+        Patch of the county values and bird sightings of the map
     """
 
-    aq_map_choropleth = render_map(month, day_slider)
+    if not paused:
+        return dash.no_update
 
     if isinstance(species, str):
-        sub_bird = bird.loc[bird['common name'] == species]
-    else:
-        sub_bird = bird.loc[bird['common name'].isin(species)]
+        species = [species]
+    month = sightings_date['month']
+    day = sightings_date['day']
+    sightings = bird_sightings(species, month, day)
+
+    aq_map = Patch()
+    aq_map['data'][0]['z'] = county_day_values(aq, aq_dates, county_order,
+                                               month, day)
+    aq_map['data'][1]['lat'] = sightings['lat']
+    aq_map['data'][1]['lon'] = sightings['lon']
+    aq_map['data'][1]['marker']['size'] = sightings['size']
+    aq_map['data'][1]['marker']['sizeref'] = sightings['sizeref']
 
-    try:
-        sub_bird = subset_date(sub_bird, 'observation date', month, day_slider)
+    return aq_map
 
-        if sub_bird['observation count'].max() < 1500:
-            maxsize = sub_bird['observation count'].max()/6
-        else:
-            maxsize = 250
 
-        aq_map_scatter = px.scatter_mapbox(
-            sub_bird, lat='latitude', lon='longitude',
-            size='observation count',
-            size_max=maxsize,
-            zoom=5, color_discrete_sequence=['#EF553B'],
-            mapbox_style="carto-positron",
-            center={"lat": 44.14495826303137, "lon": -120.60278690370761}
-        )
-        aq_map_choropleth.add_trace(aq_map_scatter.data[0])
-
-    except ValueError:
-        pass
-    return aq_map_choropleth
-
-# Separate callback for updating the county aq map
-@cache.memoize(timeout=360)
-def render_map(month, day):
-    """
-    Secondary function that actually does the choropleth map creation.
-    This is subsetting for caching purposes: if the day input does not
-    change but the species does, the map will not have to be created
-    from scratch again.
+@tiered_memoize(CACHE_DIR, CACHE_SIZE, cache_version, log_requests=True)
+def bird_sightings(species, month, day_slider):
+    """
+    Secondary function that looks up the bird sightings of the map, for
+    caching purposes.
 
     Args:
-        month (str): month input from the 'month' dropdown
-        day (int): day input from the 'day' slider
+        species (list): common names selected from dropdown
+        month (str): name of month selected from dropdown
+        day_slider (int): day value from slider
 
     Returns:
-        aq_map(choropleth_mapbox): map with county-level air quality data
-    """
-    print("Updating AQ Map...")
-    sub_aq = subset_date(aq, 'Date', month, day)
-
-    aq_map = px.choropleth_mapbox(
-            sub_aq, geojson=counties,
-            featureidkey='properties.altname', locations="County",
-            color="Avg_PM2.5", hover_name="County",
-            color_continuous_scale=px.colors.sequential.Turbo,
-            range_color=(0, 300),
-            mapbox_style='carto-positron', zoom=5,
-            center={"lat": 44.14495826303137, "lon": -120.60278690370761},
-            opacity=0.5,
-            labels={'Avg_PM2.5': 'Average PM 2.5'}
-            )
+        sightings (dict): lat, lon and size of the sighting markers, and
+            the sizeref scaling their sizes
+    """
+    sub_bird = query_rows(bird, bird_query, {'common name': species},
+                          month, day_slider)
+    counts = sub_bird['observation count']
 
-    return aq_map
+    if sub_bird.empty:
+        sizeref = 1
+    else:
+        if counts.max() < 1500:
+            maxsize = counts.max()/6
+        else:
+            maxsize = 250
+        # Same scaling as the size_max of px.scatter_mapbox
+        sizeref = float(2 * counts.max() / maxsize ** 2)
+
+    return {'lat': sub_bird['latitude'].tolist(),
+            'lon': sub_bird['longitude'].tolist(),
+            'size': counts.tolist(),
+            'sizeref': sizeref}
+
+
+# Coloring the counties by the selected day, in the browser. During
+# playback the sightings, which are only looked up for the day playback
+# pauses on, are hidden so the map never mixes two dates
+app.clientside_callback(
+    """
+    function(month, day, season, paused, figure) {
+        const choropleth = figure.data[0];
+        const values = season[month + ' ' + day] ||
+            choropleth.z.map(function() { return null; });
+        let sightings = figure.data.slice(1);
+        if (!paused) {
+            sightings = sightings.map(function(trace) {
+                const marker = Object.assign({}, trace.marker, {size: []});
+                return Object.assign({}, trace,
+                                     {lat: [], lon: [], marker: marker});
+            });
+        }
+        const data = [Object.assign({}, choropleth, {z: values})];
+        return Object.assign({}, figure, {data: data.concat(sightings)});
+    }
+    """,
+    Output('aq-map', 'figure', allow_duplicate=True),
+    Input('month', 'value'),
+    Input('day-slider', 'value'),
+    State('season-aq', 'data'),
+    State('play-interval', 'disabled'),
+    State('aq-map', 'figure'),
+    prevent_initial_call=True)
+
+
+# Passing the selected date on to the bird sightings when not playing
+app.clientside_callback(
+    """
+    function(month, day, paused) {
+        if (!paused) {
+            return window.dash_clientside.no_update;
+        }
+        return {month: month, day: day};
+    }
+    """,
+    Output('sightings-date', 'data'),
+    Input('month', 'value'),
+    Input('day-slider', 'value'),
+    Input('play-interval', 'disabled'),
+    prevent_initial_call=True)
+
+
+# Starting and pausing playback of the days of the month
+app.clientside_callback(
+    """
+    function(n_clicks, paused) {
+        return [!paused, paused ? 'Pause' : 'Play'];
+    }
+    """,
+    Output('play-interval', 'disabled'),
+    Output('play-button', 'children'),
+    Input('play-button', 'n_clicks'),
+    State('play-interval', 'disabled'),
+    prevent_initial_call=True)
+
+
+# Moving the slider to the next day during playback
+app.clientside_callback(
+    """
+    function(n_intervals, day, days) {
+        return day >= (days || 30) ? 1 : day + 1;
+    }
+    """,
+    Output('day-slider', 'value'),
+    Input('play-interval', 'n_intervals'),
+    State('day-slider', 'value'),
+    State('day-slider', 'max'),
+    prevent_initial_call=True)
 
 
 # adding indicator of the day of the month
-@app.callback(
+app.clientside_callback(
+    """
+    function(month, day) {
+        return month + ' ' + day + ', 2020';
+    }
+    """,
     Output('day-indicator', 'children'),
     Input('month', 'value'),
     Input('day-slider', 'value'))
-def display_date_aq(month, day_slider):
-    """
-    Displays the date that was selected using text.
-    Args:
-        month(str): selected month from dropdown
-        day_slider(int): selected day from slider
-    Returns:
-        Date text (str): full text of selected date
-    """
-    return str(month) + ' ' + str(day_slider) + ', 2020'
 
 
 # Setting slider day values based on month
@@ -388,15 +590,26 @@ def update_count_graph(county_name, taxon):
         count_plot (figure): plot of bird observations over time with AQI category
     """
     if isinstance(county_name, str):
-        sub_bird_county = bird.loc[bird['county'] == county_name]
         # reformat to a list to keep consistent when subsetting later
         county_name = [county_name]
-    else:
-        sub_bird_county = bird.loc[bird['county'].isin(county_name)]
 
-    haz_dates, haz_dates_offset, vh_dates, vh_dates_offset = subset_air_quality(aq, county_name)
+    return count_figure(county_name, taxon)
+
+
+@tiered_memoize(CACHE_DIR, CACHE_SIZE, cache_version)
+def count_figure(county_name, taxon):
+    """
+    Secondary function that creates the bird count graph of the selected
+    counties with their severe air quality periods, for caching purposes.
+    Args:
+        county_name (list): selected counties from dropdown
+        taxon (str): "common name", "family", or "order"
+    Returns:
+        count_plot (figure): plot of bird observations over time with AQI category
+    """
+    haz_dates, haz_dates_offset, vh_dates, vh_dates_offset = county_intervals(aq_intervals, county_name)
 
-    count_plot = plot_bird_obs(sub_bird_county, taxon)
+    count_plot = plot_bird_obs(county_name, taxon)
 
     for count, ele in enumerate(haz_dates):
         count_plot.add_vrect(x0=haz_dates[count], x1=haz_dates_offset[count],
@@ -410,30 +623,63 @@ def update_count_graph(county_name, taxon):
     return count_plot
 
 
-def plot_bird_obs(bird_df, taxonomy):
+def plot_bird_obs(county_name, taxonomy):
     """
     Subsetted function that does the actual plotting for the bird count graph.
     Selects data to plot based on the input of the species/family/order
-    RadioItem, and sums observation count across like taxonomic resolution.
+    RadioItem, reading observation counts summed across like taxonomic
+    resolution from the precomputed count cube.
 
     Args:
-        bird_df (pd dataframe): bird data filtered by county selected
+        county_name (list): counties selected from dropdown
         taxonomy (str): "common name", "family", or "order" based on what the
             user selects
     Returns:
         plot_birds (scatter): scatter plot of bird observations against date
     """
-    summed_obs = bird_df.groupby([taxonomy, 'observation date'])['observation count'].sum()
-    summed_obs_df = summed_obs.to_frame().reset_index()
+    summed_obs_df = county_counts(bird_cube, taxonomy, county_name)
 
     plot_birds = px.scatter(
         summed_obs_df, x='observation date',
         y='observation count', color=taxonomy,
         labels={taxonomy: "species", "observation date": "Date",
                           "observation count": "Observation Count"},
-        category_orders={taxonomy: sorted(bird[taxonomy].unique())})
+        category_orders={taxonomy: bird_cube[taxonomy]['order']})
     return plot_birds
 
 
+def warm_cache(top=10):
+    """
+    Precomputes the cached bird sightings of every date of the season
+    for the default species and the most requested species selections,
+    and the bird count graph of every county and taxonomic level. Runs
+    at startup when PHOENIX_WARM_CACHE is set, or from a scheduled job
+    with `python -c "import app; app.warm_cache()"`. Warming does not
+    count as requests, so it does not skew the most requested selections.
+
+    Args:
+        top (int): number of most requested species selections to warm
+    """
+    species_counts = {('American Crow',): 0}
+    for (species, month, day), count in popular_requests(
+            CACHE_DIR, bird_sightings):
+        species = tuple(species)
+        species_counts[species] = species_counts.get(species, 0) + count
+    popular = sorted(species_counts, key=species_counts.get, reverse=True)
+
+    for species in popular[:top + 1]:
+        for month, month_number in zip(full_months, months):
+            for day in range(1, calendar.monthrange(2020, month_number)[1] + 1):
+                bird_sightings.warm(list(species), month, day)
+
+    for county in county_names:
+        for taxon in ['common name', 'family', 'order']:
+            count_figure.warm([county], taxon)
+
+
+if os.environ.get('PHOENIX_WARM_CACHE'):
+    warm_cache()
+
+
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    app.run(debug=True)
\ No newline at end of file
@@ -5,32 +5,81 @@ Uses the Scikit Learn KNN method.
 
 Functions:
 
-air_quality_knn(air_quality, ebd_data)
+air_quality_knn(air_quality, ebd_data, metric='euclidean',
+                weights='uniform', n_jobs=None, executor=None,
+                cache_dir=None)
     -- Performs a 5-neighbor knn for air quality on each day
     at the locations specified by the observations in the
     eBird data.
 
-verify_location(coordinates)
+air_quality_knn_csv(air_quality, ebd_path, output_path,
+                    metric='euclidean', weights='uniform',
+                    chunksize=100000, n_jobs=None, executor=None,
+                    cache_dir=None)
+    -- Streams an eBird csv through the same knn in chunks,
+    appending the enriched rows to an output csv.
+
+estimate_air_quality(air_quality, dates, latitude, longitude,
+                     metric='euclidean', weights='uniform', out=None,
+                     n_jobs=None, executor=None, cache_dir=None)
+    -- Performs the same knn on arrays of observation dates and
+    locations, returning only the estimates without modifying
+    or copying its inputs.
+
+knn_weight_matrix(air_quality, ebd_data, metric='euclidean',
+                  weights='uniform')
+    -- Builds the sparse matrix of knn weights from the air
+    quality observations to the eBird observations.
+
+apply_knn_weights(weight_matrix, pm25)
+    -- Estimates the air quality of every eBird observation
+    from a weight matrix with one sparse product.
+
+verify_location(coordinates, county_index=None)
     -- Performs a check that the inputted gps coordinates
-    roughly fall within the state of Oregon.
+    roughly fall within the state of Oregon, or exactly
+    within its counties.
 """
 
+import hashlib
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import pandas as pd
 import numpy as np
 
-
-from sklearn.neighbors import KNeighborsRegressor
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import StandardScaler
 
+from phoenix.code import county_geometry
+from phoenix.code.file_io import atomic_file
 
-def air_quality_knn(air_quality, ebd_data):
+
+METRICS = ['euclidean', 'haversine', 'spatiotemporal']
+WEIGHTS = ['uniform', 'distance']
+
+# Default degrees of distance equivalent to one day apart in the
+# spatiotemporal metric. Above the spread of the Oregon stations (about
+# 7 degrees), so other days only count when a day has too few stations.
+TIME_SCALE = 10.0
+
+
+def air_quality_knn(air_quality, ebd_data, metric='euclidean',
+                    weights='uniform', n_jobs=None, executor=None,
+                    cache_dir=None, time_scale=TIME_SCALE):
 
     """
     Performs knn for the given data around a query point.
     Each query point has a location and a date for which
     the air quality is to be calculated.
 
+    Both dataframes are modified: their date columns are converted
+    to datetime format and 'Avg_PM2.5' is added to ebd_data. Use
+    estimate_air_quality to leave the inputs untouched.
+
     Args:
         air_quality_data (pandas dataframe): full air quality
             dataset for the state of Oregon. Listed below are
@@ -44,20 +93,62 @@ def air_quality_knn(air_quality, ebd_data):
             These are the points for which the k-nearest-neighbors
             are to be found.
 
+        metric (str): how distances between locations are measured.
+            'euclidean' (default) standardizes the latitude and
+            longitude of each day's stations and uses the euclidean
+            distance between them. 'haversine' uses the great-circle
+            distance on a BallTree of the locations in radians, with
+            no per-day scaling. 'spatiotemporal' fits a single index
+            over (latitude, longitude, date) across all station-days
+            of the season, with one day apart counting as time_scale
+            degrees apart, so days with fewer than 5 stations borrow
+            neighbors from adjacent days instead of yielding NaN.
+            Observations outside the dates of the air quality data
+            still yield NaN. n_jobs, executor and cache_dir do not
+            apply to this single fit and query.
+
+        weights (str): how the 5 neighbors are averaged. 'uniform'
+            (default) takes their mean, 'distance' weights each by the
+            inverse of its distance.
+
+        n_jobs (int): number of worker processes the days are split
+            across. None or 1 (default) runs serially, -1 uses every
+            available core.
+
+        executor (concurrent.futures.Executor): an existing executor
+            to run the days on instead of starting a new process pool.
+            Overrides n_jobs.
+
+        cache_dir (str): optional directory of stored daily results.
+            Each day's estimates are saved under a hash of that day's
+            station data and bird locations, and reused by later runs
+            in which neither has changed, so only new or changed days
+            are computed.
+
+        time_scale (float): degrees of distance one day apart counts
+            as in the spatiotemporal metric. With the default, larger
+            than the spread of the stations, days on which 5 or more
+            stations reported use only their own stations, as the
+            daily metrics do, and other days are only drawn on to
+            fill days with fewer stations. Smaller scales also blend
+            stations of nearby days into fully reported days.
+
     Returns:
         ebd_data (pandas dataframe): the inputted dataset with an
             additional column 'Avg_PM2.5' that gives the air quality
             for an observation.
 
     Warnings:
-        'NaN produced: <5 neighbors for (day)'
+        'NaN produced: <5 neighbors for (n) days: (days)'
             Days for which there may be fewer than 5 air quality
-            observations will yield NaN values.
+            observations will yield NaN values. All such days are
+            reported together in a single warning. Not raised for
+            the spatiotemporal metric.
 
     Raises:
         TypeError: If the input data are not both pandas DataFrames.
         ValueError: If the inputs are swapped or the column naming
-            is incorrect.
+            is incorrect, or if the metric or weights are not supported.
 
     """
 
@@ -77,23 +168,12 @@ def air_quality_knn(air_quality, ebd_data):
     if not categ_in_air or not tax_in_birds:
         raise ValueError("Input order may be reversed, otherwise check column names")
 
-    # Convert the air-quality dates to datetime format and
-    # remove the data points that occur after September to match
-    # the eBird data.
-    air_quality['Date'] = pd.to_datetime(air_quality['Date'])
-    months = [10, 11, 12]
-    air_quality = air_quality[-air_quality['Date'].dt.month.isin(months)]
-
-    # Reduce the dataframe to only the relevant columns:
-    # ['Date', 'Latitude', 'Longitude', 'Avg_PM2.5']
-    air_quality_data = air_quality[['Date', 'Latitude',
-                                    'Longitude', 'Avg_PM2.5']]
-
-    # Verify that the air quality observations are in Oregon
-    verify_location(air_quality_data[['Latitude', 'Longitude']])
+    _check_options(metric, weights)
 
-    # Remove NaN values from the air quality data
-    air_quality_data = air_quality_data[air_quality_data['Avg_PM2.5'].notna()]
+    # Convert the air-quality dates to datetime format and index the
+    # reporting stations by day.
+    air_quality['Date'] = pd.to_datetime(air_quality['Date'])
+    station_index = _daily_station_index(air_quality, metric)
 
     # Also convert eBird dates to datetime format for compatibility.
     ebd_data['observation date'] = pd.to_datetime(ebd_data['observation date'])
@@ -101,98 +181,983 @@ def air_quality_knn(air_quality, ebd_data):
     # Verify that the bird observations are in Oregon
     verify_location(ebd_data[['latitude', 'longitude']])
 
-    # Initialize a column in the eBird dataframe to hold the air
-    # quality measure for each observation.
-    ebd_data['Avg_PM2.5'] = np.nan
+    # Estimate the air quality for every bird observation in a single
+    # grouped pass over the dates, then attach the predictions as the
+    # new column in one write.
+    ebd_data['Avg_PM2.5'] = _knn_by_date(
+        station_index,
+        ebd_data['observation date'].values,
+        ebd_data[['latitude', 'longitude']].values,
+        metric, weights, n_jobs, executor, cache_dir=cache_dir,
+        time_scale=time_scale)
+
+    # Return the whole eBird dataset with new column for air quality.
+    return ebd_data
+
+
+def estimate_air_quality(air_quality, dates, latitude, longitude,
+                         metric='euclidean', weights='uniform', out=None,
+                         n_jobs=None, executor=None, cache_dir=None,
+                         time_scale=TIME_SCALE):
+
+    """
+    Array version of air_quality_knn. Estimates the air quality at
+    each observation from the observation dates and locations alone,
+    which may be numpy arrays or dataframe columns. Unlike
+    air_quality_knn, no input is modified and no copy of the eBird
+    data is made: only the array of estimates is returned, or written
+    into a caller-supplied buffer.
+
+    Args:
+        air_quality (pandas dataframe): full air quality dataset,
+            as for air_quality_knn. It is not modified.
+
+        dates (array): date of each observation, as datetime64 values
+            or as strings that pandas can parse.
+
+        latitude (array): latitude of each observation.
+
+        longitude (array): longitude of each observation.
+
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+
+        out (numpy array): optional float array with one element per
+            observation that the estimates are written into.
+
+        n_jobs (int): number of worker processes, see air_quality_knn.
+            Ignored for the spatiotemporal metric.
+
+        executor (concurrent.futures.Executor): see air_quality_knn.
+            Ignored for the spatiotemporal metric.
+
+        cache_dir (str): directory of stored daily results, see
+            air_quality_knn. Ignored for the spatiotemporal metric.
+
+        time_scale (float): degrees of distance one day apart counts
+            as in the spatiotemporal metric, see air_quality_knn.
+
+    Returns:
+        predictions (numpy array): estimated Avg_PM2.5 for each
+            observation, NaN where no estimate could be made. This is
+            out itself when a buffer is given.
+
+    Warnings:
+        'NaN produced: <5 neighbors for (n) days: (days)'
+        'Coordinates not in Oregon at (n) indices: (indices)'
+            The indices are positions in the inputted arrays.
+
+    Raises:
+        TypeError: If the air quality data is not a pandas DataFrame.
+        ValueError: If the air quality data has no 'Date' column, the
+            observation arrays or the buffer differ in length, or if
+            the metric or weights are not supported.
+    """
+
+    if not isinstance(air_quality, pd.DataFrame):
+        raise TypeError("Incorrect data type. Must be pandas DataFrame.")
+
+    if 'Date' not in air_quality:
+        raise ValueError("Air quality data is missing the 'Date' column")
+
+    _check_options(metric, weights)
+
+    dates = np.asarray(dates)
+    if not np.issubdtype(dates.dtype, np.datetime64):
+        dates = pd.to_datetime(dates).values
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+
+    if not len(dates) == len(latitude) == len(longitude):
+        raise ValueError("Dates, latitudes and longitudes differ in length")
+
+    if out is not None and len(out) != len(dates):
+        raise ValueError("Output buffer must have one element per observation")
+
+    station_index = _daily_station_index(
+        air_quality.assign(Date=pd.to_datetime(air_quality['Date'])), metric)
+
+    _check_oregon(latitude, longitude, np.arange(len(latitude)))
+
+    return _knn_by_date(station_index, dates,
+                        np.column_stack([latitude, longitude]),
+                        metric, weights, n_jobs, executor,
+                        cache_dir=cache_dir, out=out, time_scale=time_scale)
+
+
+def air_quality_knn_csv(air_quality, ebd_path, output_path,
+                        metric='euclidean', weights='uniform',
+                        chunksize=100000, n_jobs=None, executor=None,
+                        cache_dir=None, time_scale=TIME_SCALE):
+
+    """
+    Streaming version of air_quality_knn for eBird files too large to
+    fit in memory. The eBird csv is read in chunks, each chunk is
+    enriched against an in-memory daily index of the air quality
+    stations, and is then appended to the output csv. Peak memory is
+    bounded by the chunk size, not by the size of the input file.
+
+    Args:
+        air_quality (pandas dataframe): full air quality dataset for
+            the state of Oregon, as for air_quality_knn. It is not
+            modified.
+
+        ebd_path (str): path to the eBird observation csv. Must have
+            the columns (observation date, latitude, longitude).
+
+        output_path (str): path of the csv to write, with the columns
+            of the eBird csv plus 'Avg_PM2.5'. Overwritten if present.
+
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+
+        chunksize (int): number of eBird rows read at a time.
+
+        n_jobs (int): number of worker processes, see air_quality_knn.
+            Ignored for the spatiotemporal metric.
+
+        executor (concurrent.futures.Executor): see air_quality_knn.
+            Ignored for the spatiotemporal metric.
+
+        cache_dir (str): directory of stored daily results, see
+            air_quality_knn. Ignored for the spatiotemporal metric.
+
+        time_scale (float): degrees of distance one day apart counts
+            as in the spatiotemporal metric, see air_quality_knn.
+
+    Returns:
+        rows (int): the number of observations written.
+
+    Warnings:
+        'NaN produced: <5 neighbors for (n) days: (days)'
+
+    Raises:
+        TypeError: If the air quality data is not a pandas DataFrame.
+        ValueError: If the air quality data has no 'Date' column, the
+            eBird csv is missing a required column, or if the metric
+            or weights are not supported.
+    """
+
+    if not isinstance(air_quality, pd.DataFrame):
+        raise TypeError("Incorrect data type. Must be pandas DataFrame.")
+
+    if 'Date' not in air_quality:
+        raise ValueError("Air quality data is missing the 'Date' column")
+
+    _check_options(metric, weights)
+
+    air_quality = air_quality.assign(Date=pd.to_datetime(air_quality['Date']))
+    station_index = _daily_station_index(air_quality, metric)
+
+    # TextFileReader is only a context manager from pandas 1.2.
+    reader = pd.read_csv(ebd_path, chunksize=chunksize)
+
+    # Start one process pool for the whole file rather than per chunk.
+    pool = None
+    if executor is None and n_jobs not in (None, 1):
+        workers = os.cpu_count() if n_jobs == -1 else n_jobs
+        pool = executor = ProcessPoolExecutor(max_workers=workers)
+
+    # Station indexes fitted on earlier chunks are reused by later ones.
+    indexes = {}
+    rows = 0
+
+    try:
+        for chunk in reader:
+
+            if not {'observation date', 'latitude', 'longitude'} <= set(chunk):
+                raise ValueError("eBird data is missing date or location columns")
+
+            chunk['observation date'] = pd.to_datetime(chunk['observation date'])
+            verify_location(chunk[['latitude', 'longitude']])
+
+            chunk['Avg_PM2.5'] = _knn_by_date(
+                station_index,
+                chunk['observation date'].values,
+                chunk[['latitude', 'longitude']].values,
+                metric, weights, executor=executor, indexes=indexes,
+                cache_dir=cache_dir, time_scale=time_scale)
+
+            chunk.to_csv(output_path, mode='a' if rows else 'w',
+                         header=not rows, index=False)
+            rows += len(chunk)
+    finally:
+        reader.close()
+        if pool is not None:
+            pool.shutdown()
+
+    return rows
+
+
+def knn_weight_matrix(air_quality, ebd_data, metric='euclidean',
+                      weights='uniform', time_scale=TIME_SCALE):
+
+    """
+    Builds the knn as a sparse matrix of weights. Given the set of
+    stations reporting each day, every estimate of air_quality_knn is
+    a fixed linear combination of that day's station readings, so the
+    estimates for all days are a single sparse product of this matrix
+    with the Avg_PM2.5 column. Once built, the matrix can re-score
+    corrected or hypothetical PM2.5 values without refitting the knn.
+    Neither input is modified.
+
+    Args:
+        air_quality (pandas dataframe): full air quality dataset,
+            as for air_quality_knn.
+
+        ebd_data (pandas dataframe): eBird observations, as for
+            air_quality_knn.
+
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+
+        time_scale (float): degrees of distance one day apart counts
+            as in the spatiotemporal metric, see air_quality_knn.
+
+    Returns:
+        weight_matrix (scipy csr_matrix): weights of shape
+            (len(ebd_data), len(air_quality)). Row i holds the weights
+            of the air quality rows (station-days) used for the i-th
+            eBird observation, and is empty when no estimate could be
+            made.
+
+    Warnings:
+        'NaN produced: <5 neighbors for (n) days: (days)'
+
+    Raises:
+        TypeError: If the input data are not both pandas DataFrames.
+        ValueError: If the inputs are swapped or the column naming
+            is incorrect, or if the metric or weights are not supported.
+    """
+
+    air_is_df = isinstance(air_quality, pd.DataFrame)
+    bird_is_df = isinstance(ebd_data, pd.DataFrame)
+
+    if not air_is_df or not bird_is_df:
+        raise TypeError("Incorrect data type. Must be pandas DataFrame.")
+
+    if 'Date' not in air_quality or 'observation date' not in ebd_data:
+        raise ValueError("Input order may be reversed, otherwise check column names")
+
+    _check_options(metric, weights)
+
+    station_index = _daily_station_index(
+        air_quality.assign(Date=pd.to_datetime(air_quality['Date'])), metric)
+    bird_dates = pd.to_datetime(ebd_data['observation date']).values
+    bird_coords = ebd_data[['latitude', 'longitude']].to_numpy(dtype=float)
+
+    verify_location(ebd_data[['latitude', 'longitude']])
+
+    rows, columns, data = [], [], []
+
+    if metric == 'spatiotemporal':
+        # One query over the whole season.
+        birds, x_test = _season_queries(station_index, bird_dates, bird_coords)
+        if len(birds):
+            x_train, _, season_rows = station_index[2]
+            index = _fit_station_index(x_train, metric, time_scale)
+            neighbors, neighbor_weights = _neighbor_weights(index, [x_test], weights)
+            rows.append(np.repeat(birds, neighbors.shape[1]))
+            columns.append(season_rows[neighbors].ravel())
+            data.append(neighbor_weights.ravel())
+
+    entries = station_index[1]
+    station_sets = {}
+    if metric != 'spatiotemporal':
+        for i, birds in _match_days(station_index, bird_dates):
+            station_sets.setdefault(entries[i][0], []).append((i, birds))
+
+    for group in station_sets.values():
+
+        index = _fit_station_index(entries[group[0][0]][1], metric)
+        x_tests = [bird_coords[birds] for _, birds in group]
+        neighbors, neighbor_weights = _neighbor_weights(index, x_tests, weights)
+
+        # Map each day's neighbors to the rows of its station readings.
+        start = 0
+        for i, birds in group:
+            stop = start + len(birds)
+            rows.append(np.repeat(birds, neighbors.shape[1]))
+            columns.append(entries[i][3][neighbors[start:stop]].ravel())
+            data.append(neighbor_weights[start:stop].ravel())
+            start = stop
 
-    # Now iterate over each day that the data describes, creating
-    # a separate knn for each. This will allow us to estimate air
-    # quality for a certain location on a certain day.
-    for day in air_quality_data['Date'].unique():
+    shape = (len(ebd_data), len(air_quality))
+    if not rows:
+        return sparse.csr_matrix(shape)
 
-        # Define the 'training' data: the observed air quality
-        # at the station locations on the respective day.
-        air_today = air_quality_data[air_quality_data['Date'] == day]
-        x_train = air_today[['Latitude', 'Longitude']]
-        y_train = air_today['Avg_PM2.5']
+    return sparse.csr_matrix((np.concatenate(data),
+                              (np.concatenate(rows), np.concatenate(columns))),
+                             shape=shape)
+
+
+def apply_knn_weights(weight_matrix, pm25):
+
+    """
+    Estimates the air quality of every eBird observation with a single
+    sparse matrix-vector product.
+
+    Args:
+        weight_matrix (scipy sparse matrix): output of knn_weight_matrix.
+        pm25 (array): Avg_PM2.5 of each air quality row, in the order
+            of the air quality data the matrix was built from, e.g.
+            corrected or hypothetical readings.
+
+    Returns:
+        predictions (numpy array): estimated Avg_PM2.5 for each eBird
+            observation, NaN where no estimate could be made.
+    """
+
+    weight_matrix = sparse.csr_matrix(weight_matrix)
+    pm25 = np.asarray(pm25, dtype=float)
+
+    # Only the stored weights are read, so a missing reading makes the
+    # estimates using it missing and leaves the others unchanged.
+    # Observations with no weights have no estimate, rather than zero.
+    predictions = weight_matrix @ pm25
+    predictions[np.diff(weight_matrix.indptr) == 0] = np.nan
+
+    return predictions
+
+
+def _check_options(metric, weights):
+
+    """
+    Raises a ValueError if the metric or the weights are not supported.
+    """
+
+    if metric not in METRICS:
+        raise ValueError(f"Unsupported metric. Must be one of {METRICS}")
+
+    if weights not in WEIGHTS:
+        raise ValueError(f"Unsupported weights. Must be one of {WEIGHTS}")
+
+
+def _daily_station_index(air_quality, metric='euclidean'):
+
+    """
+    Indexes the air quality stations that report on each day, after
+    removing the months with no eBird data, checking the station
+    locations and dropping missing values.
+
+    Args:
+        air_quality (pandas dataframe): air quality data with the
+            columns (Date, Latitude, Longitude, Avg_PM2.5), where Date
+            is already in datetime format.
+        metric (str): the metric the index is for. Days with fewer
+            than 5 stations are only reported for the daily metrics.
+
+    Returns:
+        station_index (tuple): the sorted days with at least 5 stations
+            reporting; for each of those days a tuple of the key of
+            its station set (see _station_key), the station locations,
+            their Avg_PM2.5 values and their row positions in the
+            inputted air quality data; and the same three arrays for
+            every station-day of the season, with the day (see
+            _day_numbers) as a third location column.
+
+    Warnings:
+        'NaN produced: <5 neighbors for (n) days: (days)'
+    """
+
+    # Remove the data points that occur after September to match
+    # the eBird data.
+    months = [10, 11, 12]
+    in_season = ~air_quality['Date'].dt.month.isin(months).to_numpy()
+
+    # Verify that the air quality observations are in Oregon
+    verify_location(air_quality.loc[in_season, ['Latitude', 'Longitude']])
+
+    # Remove NaN values from the air quality data, keeping track of the
+    # position of the remaining rows.
+    air_rows = np.flatnonzero(in_season & air_quality['Avg_PM2.5'].notna().to_numpy())
+
+    air_coords = air_quality[['Latitude', 'Longitude']].to_numpy(dtype=float)[air_rows]
+    air_values = air_quality['Avg_PM2.5'].to_numpy()[air_rows]
+    air_dates = air_quality['Date'].values[air_rows]
+    air_order, air_days, air_bounds = _date_groups(air_dates)
+
+    days = []
+    entries = []
+    skipped_days = []
+
+    for i, day in enumerate(air_days):
+
+        stations = air_order[air_bounds[i]:air_bounds[i + 1]]
 
         # Skip over days when there aren't enough air quality points
         # to produce 5 nearest neighbors.
-        if len(air_today['Latitude']) < 5:
-            date = pd.to_datetime(day).date()
-            warnings.warn(f"NaN produced: <5 neighbors for {date}")
+        if len(stations) < 5:
+            skipped_days.append(str(pd.to_datetime(day).date()))
             continue
-        else:
-            pass
 
-        # Define the 'test' or 'query' data: the locations of
-        # the bird observations on the respective day.
-        birds_today = ebd_data[ebd_data['observation date'] == day]
-        x_test = birds_today[['latitude', 'longitude']]
+        stations, key = _station_key(air_coords, stations)
+        days.append(day)
+        entries.append((key, air_coords[stations], air_values[stations],
+                        air_rows[stations]))
+
+    if skipped_days and metric != 'spatiotemporal':
+        warnings.warn(f"NaN produced: <5 neighbors for {len(skipped_days)} "
+                      f"days: {', '.join(skipped_days)}")
+
+    season = (np.column_stack([air_coords, _day_numbers(air_dates)]),
+              air_values, air_rows)
+
+    return np.array(days, dtype=air_days.dtype), entries, season
 
-        # Skip over this day if there aren't any bird observations.
-        if birds_today.empty is True:
+
+def _day_numbers(dates):
+
+    """
+    Converts datetime64 values to a float number of days.
+    """
+
+    return dates.astype('datetime64[ns]').astype(np.int64) / 86400e9
+
+
+def _date_groups(dates):
+
+    """
+    Partitions an array of dates into groups of equal dates.
+
+    Args:
+        dates (numpy array): datetime64 values to be grouped.
+
+    Returns:
+        order (numpy array): stable sorting order of the dates, so
+            rows keep their original order within each group.
+        unique_dates (numpy array): the sorted distinct dates.
+        bounds (numpy array): start of each group within the sorted
+            order, followed by the total number of dates. Group i
+            is order[bounds[i]:bounds[i + 1]].
+    """
+
+    order = np.argsort(dates, kind='stable')
+    unique_dates, starts = np.unique(dates[order], return_index=True)
+    bounds = np.append(starts, len(dates))
+
+    return order, unique_dates, bounds
+
+
+def _match_days(station_index, bird_dates):
+
+    """
+    Partitions the bird observations by date once, and matches each
+    date group against the days of the station index.
+
+    Args:
+        station_index (tuple): output of _daily_station_index.
+        bird_dates (numpy array): date of each bird observation.
+
+    Yields:
+        i (int): position of the day in the station index.
+        birds (numpy array): positions of the bird observations made
+            that day.
+    """
+
+    days = station_index[0]
+    bird_order, bird_days, bird_bounds = _date_groups(bird_dates)
+
+    # Position of each bird observation day among the station days.
+    matches = np.searchsorted(days, bird_days)
+
+    for j, day in enumerate(bird_days):
+
+        # Skip over this day if there aren't enough stations.
+        i = matches[j]
+        if i == len(days) or days[i] != day:
             continue
+
+        yield i, bird_order[bird_bounds[j]:bird_bounds[j + 1]]
+
+
+def _knn_by_date(station_index, bird_dates, bird_coords, metric='euclidean',
+                 weights='uniform', n_jobs=None, executor=None, indexes=None,
+                 cache_dir=None, out=None, time_scale=TIME_SCALE):
+
+    """
+    Runs the daily knn for the bird observations after partitioning
+    them by date once (see _match_days), so no day requires a scan of
+    the full datasets.
+
+    Days that share the same set of reporting stations also share a
+    single fitted station index and a single neighbor query for all of
+    their bird observations; only the PM2.5 values differ per day. Each
+    such group is an independent task, which may be run in parallel.
+
+    Args:
+        station_index (tuple): output of _daily_station_index.
+        bird_dates (numpy array): date of each bird observation.
+        bird_coords (numpy array): (latitude, longitude) of each bird
+            observation, shape (m, 2).
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+        n_jobs (int): number of worker processes, see air_quality_knn.
+        executor (concurrent.futures.Executor): see air_quality_knn.
+        indexes (dict): fitted station indexes by station set key,
+            reused and extended when running serially.
+        cache_dir (str): directory of stored daily results, see
+            air_quality_knn.
+        out (numpy array): optional buffer to write the estimates into.
+        time_scale (float): see air_quality_knn.
+
+    Returns:
+        predictions (numpy array): estimated Avg_PM2.5 for each bird
+            observation, NaN where no estimate could be made.
+    """
+
+    if out is None:
+        predictions = np.full(len(bird_dates), np.nan)
+    else:
+        predictions = out
+        predictions.fill(np.nan)
+
+    if metric == 'spatiotemporal':
+        return _knn_season(station_index, bird_dates, bird_coords, weights,
+                           indexes, predictions, time_scale)
+
+    entries = station_index[1]
+
+    # Pair up the stations and birds of each day, grouping the days
+    # by their set of reporting stations.
+    station_sets = {}
+
+    for i, birds in _match_days(station_index, bird_dates):
+
+        digest = None
+
+        # Reuse the stored estimates if this day is unchanged.
+        if cache_dir is not None:
+            birds, digest = _day_digest(f"{metric}:{weights}", entries[i],
+                                        bird_coords, birds)
+            path = os.path.join(cache_dir, digest + '.npy')
+            if os.path.exists(path):
+                predictions[birds] = np.load(path)
+                continue
+
+        station_sets.setdefault(entries[i][0], []).append((i, birds, digest))
+
+    # Give each task only the slices of the data for its own days.
+    tasks = []
+    for group in station_sets.values():
+        tasks.append((entries[group[0][0]][1],
+                      [entries[i][2] for i, _, _ in group],
+                      [bird_coords[birds] for _, birds, _ in group],
+                      metric, weights))
+
+    if executor is not None:
+        results = list(executor.map(_knn_station_set, *zip(*tasks)))
+    elif n_jobs not in (None, 1) and len(tasks) > 1:
+        workers = os.cpu_count() if n_jobs == -1 else n_jobs
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_knn_station_set, *zip(*tasks)))
+    else:
+        if indexes is None:
+            indexes = {}
+        results = []
+        for key, task in zip(station_sets, tasks):
+            if key not in indexes:
+                indexes[key] = _fit_station_index(task[0], metric)
+            results.append(_knn_station_set(*task, index=indexes[key]))
+
+    # Results come back in task order, so the merge is deterministic.
+    for group, day_predictions in zip(station_sets.values(), results):
+        for (_, birds, digest), y_pred in zip(group, day_predictions):
+            predictions[birds] = y_pred
+            if cache_dir is not None:
+                _save_day(cache_dir, digest, y_pred)
+
+    return predictions
+
+
+def _season_queries(station_index, bird_dates, bird_coords):
+
+    """
+    Selects the bird observations made within the dates of the air
+    quality data and adds their day as a third location column.
+
+    Args:
+        station_index (tuple): output of _daily_station_index.
+        bird_dates (numpy array): date of each bird observation.
+        bird_coords (numpy array): (latitude, longitude) of each bird
+            observation, shape (m, 2).
+
+    Returns:
+        birds (numpy array): positions of the selected observations.
+        x_test (numpy array): their (latitude, longitude, day).
+    """
+
+    x_train = station_index[2][0]
+    bird_days = _day_numbers(bird_dates)
+
+    if len(x_train) == 0:
+        return np.array([], dtype=int), np.empty((0, 3))
+
+    # Missing (NaT) dates fall far outside the range as well.
+    first_day = np.floor(x_train[:, 2].min())
+    last_day = np.floor(x_train[:, 2].max())
+    bird_day = np.floor(bird_days)
+    birds = np.flatnonzero((bird_day >= first_day) & (bird_day <= last_day))
+
+    return birds, np.column_stack([bird_coords[birds], bird_days[birds]])
+
+
+def _knn_season(station_index, bird_dates, bird_coords, weights='uniform',
+                indexes=None, predictions=None, time_scale=TIME_SCALE):
+
+    """
+    Runs the spatiotemporal knn: one index over every station-day of
+    the season and one query for all bird observations.
+
+    Args:
+        station_index (tuple): output of _daily_station_index.
+        bird_dates (numpy array): date of each bird observation.
+        bird_coords (numpy array): (latitude, longitude) of each bird
+            observation, shape (m, 2).
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+        indexes (dict): fitted indexes, reused and extended.
+        predictions (numpy array): buffer to write the estimates into.
+        time_scale (float): see air_quality_knn.
+
+    Returns:
+        predictions (numpy array): estimated Avg_PM2.5 for each bird
+            observation, NaN outside the dates of the air quality data.
+    """
+
+    if predictions is None:
+        predictions = np.full(len(bird_dates), np.nan)
+    if indexes is None:
+        indexes = {}
+
+    birds, x_test = _season_queries(station_index, bird_dates, bird_coords)
+    x_train, y_train, _ = station_index[2]
+
+    if len(birds) == 0 or len(x_train) < 5:
+        return predictions
+
+    key = ('spatiotemporal', time_scale)
+    if key not in indexes:
+        indexes[key] = _fit_station_index(x_train, 'spatiotemporal',
+                                          time_scale)
+
+    predictions[birds] = _knn_station_set(x_train, [y_train], [x_test],
+                                          'spatiotemporal', weights,
+                                          indexes[key])[0]
+
+    return predictions
+
+
+def _day_digest(method, entry, bird_coords, birds):
+
+    """
+    Hashes everything that determines one day's estimates: the method,
+    the day's station locations and PM2.5 values, and the locations of
+    that day's birds. The birds are put in order of location first, so
+    a reordered but otherwise unchanged eBird extract hashes the same.
+
+    Args:
+        method (str): the metric and weights used for the estimates.
+        entry (tuple): the day's entry in the station index.
+        bird_coords (numpy array): (latitude, longitude) of each bird
+            observation, shape (m, 2).
+        birds (numpy array): rows of bird_coords observed that day.
+
+    Returns:
+        birds (numpy array): the same rows sorted by location, the
+            order in which the day's estimates are stored.
+        digest (str): hex digest naming the day's stored estimates.
+    """
+
+    coords = bird_coords[birds]
+    birds = birds[np.lexsort((coords[:, 1], coords[:, 0]))]
+
+    digest = hashlib.sha256(method.encode())
+    digest.update(entry[0])
+    digest.update(np.ascontiguousarray(entry[2], dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(bird_coords[birds], dtype=float).tobytes())
+
+    return birds, digest.hexdigest()
+
+
+def _save_day(cache_dir, digest, y_pred):
+
+    """
+    Stores one day's estimates in the cache directory. The file is
+    written under a temporary name and then renamed, so concurrent
+    runs never read a partially written result.
+
+    Args:
+        cache_dir (str): directory of stored daily results.
+        digest (str): output of _day_digest for the day.
+        y_pred (numpy array): the day's estimates.
+    """
+
+    path = os.path.join(cache_dir, digest + '.npy')
+    with atomic_file(path) as day_file:
+        np.save(day_file, y_pred)
+
+
+def _knn_station_set(x_train, y_trains, x_tests, metric='euclidean',
+                     weights='uniform', index=None):
+
+    """
+    Performs the knn for a group of days that share the same stations.
+    One index and one query cover the bird locations of every day, and
+    the shared neighbors are then re-weighted with each day's values.
+
+    Args:
+        x_train (numpy array): the shared station locations.
+        y_trains (list): Avg_PM2.5 at those stations for each day.
+        x_tests (list): bird observation locations for each day.
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
+        index (tuple): an already fitted index over x_train, see
+            _fit_station_index. Fitted here if not given.
+
+    Returns:
+        y_preds (list): air quality estimates for each day's birds.
+    """
+
+    if index is None:
+        index = _fit_station_index(x_train, metric)
+    neighbors, neighbor_weights = _neighbor_weights(index, x_tests, weights)
+
+    y_preds = []
+    start = 0
+    for y_train, x_test in zip(y_trains, x_tests):
+        stop = start + len(x_test)
+        y_neighbors = y_train[neighbors[start:stop]]
+        if weights == 'uniform':
+            y_preds.append(y_neighbors.mean(axis=1))
         else:
-            pass
+            y_preds.append((y_neighbors * neighbor_weights[start:stop]).sum(axis=1))
+        start = stop
 
-        # Normalize and fit the location data to ensure proper scaling.
-        scaler = StandardScaler()
-        scaler.fit(x_train)
+    return y_preds
 
-        x_train_norm = scaler.transform(x_train)
-        x_test_norm = scaler.transform(x_test)
 
-        # Perform k-nearest-neighbors regression on continuous data.
-        regressor = KNeighborsRegressor(n_neighbors=5)
-        regressor.fit(x_train_norm, y_train)
+def _neighbor_weights(index, x_tests, weights='uniform'):
 
-        # Output the air quality predictions for the locations of the
-        # bird observations on this day, maintaining the indexing from
-        # the original dataset.
-        y_pred = regressor.predict(x_test_norm)
+    """
+    Queries a station index for the bird locations of several days at
+    once and weights the neighbors found for each location.
 
-        y_pred = pd.DataFrame(y_pred, columns=['Avg_PM2.5'])
-        y_pred = y_pred.set_index(x_test.index)
+    Args:
+        index (tuple): output of _fit_station_index.
+        x_tests (list): bird observation locations for each day.
+        weights (str): 'uniform' or 'distance', see air_quality_knn.
 
-        # Finally, add these outputs to the dataset to get the air quality
-        # at the day and location of the bird observation.
-        ind = x_test.index[:].tolist()
-        ebd_data.loc[ind, 'Avg_PM2.5'] = y_pred
+    Returns:
+        neighbors (numpy array): positions of the nearest stations,
+            shape (m, 5) for the m locations of all days together.
+        neighbor_weights (numpy array): weight of each neighbor, each
+            row summing to 1.
+    """
 
-    # Return the whole eBird dataset with new column for air quality.
-    return ebd_data
+    distances, neighbors = _query_station_index(index, np.concatenate(x_tests),
+                                                return_distance=True)
+
+    if weights == 'uniform':
+        return neighbors, np.full(neighbors.shape, 1 / neighbors.shape[1])
+
+    # Inverse distances; a location on top of a station takes the
+    # value of that station (or the mean of several coincident ones).
+    with np.errstate(divide='ignore'):
+        inverse = 1 / distances
+    coincident = np.isinf(inverse).any(axis=1)
+    inverse[coincident] = np.isinf(inverse[coincident])
+
+    return neighbors, inverse / inverse.sum(axis=1, keepdims=True)
+
+
+def _station_key(air_coords, stations):
+
+    """
+    Puts a day's stations into a canonical order and derives a key
+    identifying the set of station locations reporting that day.
 
+    Args:
+        air_coords (numpy array): (latitude, longitude) of each air
+            quality observation, shape (n, 2).
+        stations (numpy array): rows of air_coords reporting that day.
+
+    Returns:
+        stations (numpy array): the same rows sorted by location.
+        key (bytes): identical for any day with the same stations.
+    """
+
+    coords = air_coords[stations]
+    stations = stations[np.lexsort((coords[:, 1], coords[:, 0]))]
+
+    return stations, air_coords[stations].tobytes()
 
-def verify_location(coordinates):
+
+def _fit_station_index(x_train, metric='euclidean', time_scale=TIME_SCALE):
+
+    """
+    Fits the 5-nearest-neighbor index over a set of station locations.
+
+    Args:
+        x_train (numpy array): station locations, shape (n, 2), or
+            station (latitude, longitude, day), shape (n, 3), for the
+            spatiotemporal metric.
+        metric (str): 'euclidean', 'haversine' or 'spatiotemporal', see
+            air_quality_knn.
+        time_scale (float): degrees one day apart counts as, for the
+            spatiotemporal metric.
+
+    Returns:
+        index (tuple): the transform applied to query locations and
+            the fitted sklearn NearestNeighbors.
+    """
+
+    if metric == 'haversine':
+        # Great-circle distances need no scaling: build a BallTree on
+        # the station locations in radians.
+        transform = np.radians
+        tree = NearestNeighbors(n_neighbors=5, algorithm='ball_tree',
+                                metric='haversine')
+    elif metric == 'spatiotemporal':
+        # Place the locations on a sphere measured in degrees, so
+        # stations of the same day are ranked as by the haversine
+        # metric, and turn days into degrees.
+        transform = partial(_spacetime_coords, time_scale=time_scale)
+        tree = NearestNeighbors(n_neighbors=5)
+    else:
+        # Normalize the location data to ensure proper scaling.
+        transform = StandardScaler().fit(x_train).transform
+        tree = NearestNeighbors(n_neighbors=5)
+
+    tree.fit(transform(x_train))
+
+    return transform, tree
+
+
+def _spacetime_coords(points, time_scale=TIME_SCALE):
+
+    """
+    Converts (latitude, longitude, day) to points on a sphere of one
+    degree per unit of arc, with the day times time_scale as a fourth
+    coordinate. Straight-line distances between same-day points grow
+    with their great-circle distance, so their order is the same.
+
+    Args:
+        points (numpy array): (latitude, longitude, day), shape (n, 3).
+        time_scale (float): degrees one day apart counts as.
+
+    Returns:
+        coords (numpy array): the converted points, shape (n, 4).
+    """
+
+    latitude, longitude = np.radians(points[:, 0]), np.radians(points[:, 1])
+    radius = np.degrees(1)
+
+    return np.column_stack([radius * np.cos(latitude) * np.cos(longitude),
+                            radius * np.cos(latitude) * np.sin(longitude),
+                            radius * np.sin(latitude),
+                            time_scale * points[:, 2]])
+
+
+def _query_station_index(index, x_test, return_distance=False):
+
+    """
+    Finds the 5 nearest stations to each query location.
+
+    Args:
+        index (tuple): output of _fit_station_index.
+        x_test (numpy array): bird observation locations, shape (m, 2).
+        return_distance (bool): whether to also return the distances.
+
+    Returns:
+        distances (numpy array): distance to each of the nearest
+            stations, only returned when return_distance is True.
+        neighbors (numpy array): positions of the nearest stations
+            within x_train, shape (m, 5).
+    """
+
+    transform, tree = index
+
+    return tree.kneighbors(transform(x_test), return_distance=return_distance)
+
+
+def verify_location(coordinates, county_index=None):
 
     """
     Performs a simple check of all gps coordinates found in inputs.
     If a (latitude,longitude) pair is not found within the (rough)
-    range of the state of Oregon, a ValueError is raised.
+    range of the state of Oregon, a warning is raised. The check is
+    vectorized over all coordinates and reports every offending point
+    in a single warning.
 
     Args:
-        coordinates (pandas dataframe): contains two columns, first
-            one for latitude, the other for longitude.
+        coordinates (pandas dataframe): contains two columns, one for
+            latitude, the other for longitude (in any letter case).
+
+        county_index (dict): optional county index, as built by
+            county_geometry.build_county_index. When given, points
+            inside the rough range must also fall exactly within one
+            of the county polygons.
 
     Returns:
-        None. This function simply raises warnings then passes.
+        outside (numpy array): index labels of the coordinates that
+            are not in Oregon.
 
     Warnings:
-        'Coordinate not in Oregon':
+        'Coordinates not in Oregon at (n) indices: (indices)':
             If any gps coordinates in the data do not fall
-            within the predetermined (lat,long) extremes of Oregon.
+            within the predetermined (lat,long) extremes of Oregon,
+            or within its counties when county_index is given.
     """
 
-    coordinates.columns = coordinates.columns.str.lower()
+    columns = coordinates.columns.str.lower()
+    lat = coordinates.iloc[:, columns.get_loc('latitude')].to_numpy(dtype=float)
+    long = coordinates.iloc[:, columns.get_loc('longitude')].to_numpy(dtype=float)
 
-    # Verify that all air quality locations are (roughly) within Oregon
-    for ind in coordinates.index:
+    return _check_oregon(lat, long, coordinates.index.to_numpy(), county_index)
 
-        lat = coordinates.at[ind, 'latitude']
-        long = coordinates.at[ind, 'longitude']
 
-        if (40 <= lat <= 47) and (-125 <= long <= -115):
-            pass
-        else:
-            warnings.warn(f"Coordinate not in Oregon at index: {ind}")
+def _check_oregon(lat, long, labels, county_index=None):
+
+    """
+    Array implementation of verify_location.
+
+    Args:
+        lat (numpy array): latitude of each point.
+        long (numpy array): longitude of each point.
+        labels (numpy array): label reported for each point.
+        county_index (dict): optional county index, see
+            verify_location.
+
+    Returns:
+        outside (numpy array): labels of the points not in Oregon.
+    """
+
+    # Verify that all locations are (roughly) within Oregon
+    inside = (40 <= lat) & (lat <= 47) & (-125 <= long) & (long <= -115)
+
+    # Optionally confirm the remaining points against the county shapes.
+    if county_index is not None:
+        candidates = np.flatnonzero(inside)
+        counties = county_geometry.locate_points(
+            county_index, lat[candidates], long[candidates])
+        inside[candidates[counties == -1]] = False
+
+    outside = labels[~inside]
+
+    if len(outside) > 0:
+        shown = ', '.join(str(ind) for ind in outside[:10])
+        if len(outside) > 10:
+            shown += ', ...'
+        warnings.warn(f"Coordinates not in Oregon at {len(outside)} "
+                      f"indices: {shown}")
+
+    return outside
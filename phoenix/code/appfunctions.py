@@ -1,23 +1,192 @@
-
 """
 Contains functions for manipulating data used in the phoenix app.
 Functions:
     1) subset_date: given a month and a day,
         subsets dataframe to only those dates.
-    2) subset_air_quality: given a county, creates lists of dates,
+    2) build_date_index: sorts a dataframe by day of the year and maps
+        each day to its slice of rows, for constant time subset_date.
+    3) build_query_index: maps each value of the filter columns to its
+        row positions.
+    4) query_orders: returns the row orders of the query index, to be
+        stored and shared between processes.
+    5) query_rows: subsets a dataframe to the rows matching filters on
+        several columns and a date, using the query index.
+    6) county_day_values: lists the PM2.5 of each county on a date, to
+        update the air quality map without rebuilding it.
+    7) season_values: lists the PM2.5 of each county on every date of
+        the selected months, to be sent to the browser once.
+    8) subset_air_quality: given a county, creates lists of dates,
         and day after of very unhealhty and hazardous air quality.
+    9) severe_aq_intervals: for every county, merges runs of consecutive
+        very unhealthy or hazardous days into single intervals.
+    10) county_intervals: looks up the merged intervals of counties.
+    11) build_count_cube: sums bird observation counts by taxon, county
+        and date once, for every taxonomic level.
+    12) county_counts: reads the summed counts of counties from the cube.
 
 """
 
+import numpy as np
 import pandas as pd
 
 # variables
 
 months = [6, 7, 8, 9]
 full_months = ['June', 'July', 'August', 'September']
+month_numbers = dict(zip(full_months, months))
+
+
+def build_date_index(data_frame, df_date):
+    """
+    Sorts the dataframe by month and day, and maps each (month, day) to
+    the slice of rows with that date, so that subset_date can find the
+    rows of a date in constant time without scanning the dataframe.
+
+    Args:
+        data_frame (dataframe): dataframe to be indexed
+        df_date (str): name of column that holds datetime values
+
+    Returns:
+        sorted_df (dataframe): the dataframe sorted by month and day,
+            keeping the original order within each date
+        date_index (dict): slice of rows of sorted_df, by (month, day)
+    """
+
+    dates = data_frame[df_date]
+    day_keys = (dates.dt.month * 100 + dates.dt.day).to_numpy(dtype=float)
+
+    # A dataframe that is already sorted, e.g. one loaded from a shared
+    # store, is kept as is rather than copied.
+    dated = day_keys[:np.count_nonzero(~np.isnan(day_keys))]
+    unsorted = np.isnan(dated).any() or (np.diff(dated) < 0).any()
+    sorted_df = data_frame
+    if unsorted:
+        order = np.argsort(day_keys, kind='stable')
+        sorted_df = data_frame.iloc[order]
+        day_keys = day_keys[order]
+
+    keys, starts = np.unique(day_keys, return_index=True)
+    stops = np.append(starts[1:], len(day_keys))
+
+    date_index = {}
+    for key, start, stop in zip(keys, starts, stops):
+        if not np.isnan(key):
+            date_index[divmod(int(key), 100)] = slice(start, stop)
+
+    return sorted_df, date_index
+
+
+def build_query_index(data_frame, columns, date_index=None, orders=None):
+    """
+    Builds an inverted index over the filter columns of a dataframe,
+    mapping each value to the sorted positions of the rows holding it.
+
+    Args:
+        data_frame (dataframe): dataframe to be indexed
+        columns (list): names of the columns to index
+        date_index (dict): optional index from build_date_index, in
+            which case data_frame must be the sorted dataframe returned
+            with it
+        orders (dict): optional row orders of the columns, from
+            query_orders, e.g. memory-mapped from a shared store; the
+            positions of each value are then views of these arrays
+
+    Returns:
+        query_index (dict): positions by value under 'columns', by
+            column name, and the date index under 'dates'
+    """
+
+    query_index = {'columns': {}, 'dates': date_index}
+
+    for column in columns:
+        codes, values = pd.factorize(data_frame[column])
+        if orders is None:
+            order = _column_order(codes)
+        else:
+            order = orders[column]
+        counts = np.bincount(codes[codes >= 0], minlength=len(values))
+
+        # Rows with missing values sort first and are left out.
+        stops = np.cumsum(counts) + np.count_nonzero(codes < 0)
+        query_index['columns'][column] = {
+            value: order[stop - count:stop]
+            for value, count, stop in zip(values, counts, stops)}
+
+    return query_index
+
+
+def query_orders(data_frame, columns):
+    """
+    Returns the row order build_query_index sorts each filter column
+    in, so it can be stored once and shared instead of recomputed.
+
+    Args:
+        data_frame (dataframe): dataframe to be indexed
+        columns (list): names of the columns to index
 
+    Returns:
+        orders (dict): positions of the rows sorted by value, by column
+            name
+    """
+
+    return {column: _column_order(pd.factorize(data_frame[column])[0])
+            for column in columns}
+
+
+def query_rows(data_frame, query_index, filters, month=None, day=None):
+    """
+    Subsets the dataframe to the rows matching every filter, by
+    intersecting the row positions of the filter values instead of
+    scanning the columns.
+
+    Args:
+        data_frame (dataframe): dataframe indexed by build_query_index
+        query_index (dict): output of build_query_index
+        filters (dict): value or list of values to keep, by column name
+        month (str): optional month of interest; needs the query index
+            to have been built with a date index
+        day (int): day of interest, with month
+
+    Returns:
+        new_df (dataframe): the matching rows, in dataframe order
+    """
+
+    if month is None:
+        rows = slice(0, len(data_frame))
+    else:
+        date_key = (month_numbers[month], day)
+        rows = query_index['dates'].get(date_key, slice(0, 0))
+
+    selections = []
+    for column, values in filters.items():
+        if isinstance(values, str):
+            values = [values]
+        positions = query_index['columns'][column]
+        positions = [positions[value] for value in values if value in positions]
+
+        if len(positions) == 0:
+            positions = np.array([], dtype=np.int64)
+        elif len(positions) == 1:
+            positions = positions[0]
+        else:
+            positions = np.sort(np.concatenate(positions))
+
+        # Narrow the sorted positions to the date's slice of rows.
+        start, stop = np.searchsorted(positions, [rows.start, rows.stop])
+        selections.append(positions[start:stop])
+
+    if len(selections) == 0:
+        return data_frame.iloc[rows]
 
-def subset_date(data_frame, df_date, month, day):
+    selections.sort(key=len)
+    positions = selections[0]
+    for other in selections[1:]:
+        positions = np.intersect1d(positions, other, assume_unique=True)
+
+    return data_frame.iloc[positions]
+
+
+def subset_date(data_frame, df_date, month, day, date_index=None):
     """
     Subsets the dataframe based on the month and day selected.
 
@@ -26,6 +195,8 @@ def subset_date(data_frame, df_date, month, day):
         df_date (str): name of column that holds datetime values
         month(str): month of interest
         day (int): day of interest
+        date_index (dict): optional index from build_date_index, in
+            which case df must be the sorted dataframe returned with it
 
     Returns:
         new_df (dataframe): subsetted dataframe
@@ -33,11 +204,14 @@ def subset_date(data_frame, df_date, month, day):
         ValueError: There are no observations for this date
     """
 
-    month_index = [
-        idx for idx,
-        element in enumerate(full_months) if element == month]
+    if date_index is not None:
+        rows = date_index.get((month_numbers[month], day))
+        if rows is None:
+            raise ValueError('There are no observations for this date')
+        return data_frame.iloc[rows]
+
     new_df = data_frame.loc[data_frame[
-                            df_date].dt.month == months[month_index[0]]]
+                            df_date].dt.month == month_numbers[month]]
     new_df = new_df.loc[new_df[df_date].dt.day == day]
 
     if new_df.empty:
@@ -46,6 +220,62 @@ def subset_date(data_frame, df_date, month, day):
     return new_df
 
 
+def county_day_values(df, date_index, county_order, month, day):
+    """
+    Lists the PM2.5 value of each county on the selected date, in the
+    order of the counties in the air quality map, so that only these
+    values need to be sent when the date changes.
+
+    Args:
+        df (pandas dataframe): air quality dataframe sorted by
+            build_date_index
+        date_index (dict): date index of df from build_date_index
+        county_order (list): names of the counties in map order
+        month (str): month of interest
+        day (int): day of interest
+    Returns:
+        values (list): PM2.5 of each county, None where it is missing
+    """
+    try:
+        sub_aq = subset_date(df, 'Date', month, day, date_index)
+    except ValueError:
+        return [None] * len(county_order)
+
+    pm25 = pd.Series(sub_aq['Avg_PM2.5'].to_numpy(),
+                     index=sub_aq['County'].astype(object))
+    pm25 = pm25.reindex(county_order).to_numpy()
+
+    return [None if np.isnan(value) else float(value) for value in pm25]
+
+
+def season_values(df, date_index, county_order, month_names=full_months):
+    """
+    Lists the PM2.5 value of each county on every date of the selected
+    months that has air quality data, so that the whole season can be
+    sent to the browser once and days changed without the server.
+
+    Args:
+        df (pandas dataframe): air quality dataframe sorted by
+            build_date_index
+        date_index (dict): date index of df from build_date_index
+        county_order (list): names of the counties in map order
+        month_names (list): names of the months to include
+    Returns:
+        season (dict): the values of county_day_values of each date,
+            keyed by '<month> <day>', e.g. 'September 1'
+    """
+    month_names = {month_numbers[month]: month for month in month_names}
+
+    season = {}
+    for month_number, day in sorted(date_index):
+        if month_number in month_names:
+            month = month_names[month_number]
+            season[f'{month} {day}'] = county_day_values(
+                df, date_index, county_order, month, day)
+
+    return season
+
+
 def subset_air_quality(df, county_name):
     """
     Subsets AQ dataframe based on the county and the AQI category.
@@ -59,44 +289,177 @@ def subset_air_quality(df, county_name):
         vh_dates (list): list of dates with very unhealthy air quality
         vh_dates_offset (list): day after day with very unhealthy air quality
     """
+    _check_aq_columns(df)
+
+    sub_aq = df.loc[df['County'].isin(county_name)]
+    dates = sub_aq['Date'].to_numpy(dtype='datetime64[D]')
+    haz = (sub_aq['AQI_Category'] == 'Hazardous').to_numpy()
+    vh = (sub_aq['AQI_Category'] == 'Very Unhealthy').to_numpy()
+
+    haz_dates = np.datetime_as_string(dates[haz]).tolist()
+    haz_dates_offset = np.datetime_as_string(dates[haz] + 1).tolist()
+    vh_dates = np.datetime_as_string(dates[vh]).tolist()
+    vh_dates_offset = np.datetime_as_string(dates[vh] + 1).tolist()
+
+    return haz_dates, haz_dates_offset, vh_dates, vh_dates_offset
+
+
+def severe_aq_intervals(df):
+    """
+    Finds the periods of very unhealthy and hazardous air quality of
+    every county, merging runs of consecutive days of the same category
+    into a single interval. Meant to be run once when the data is
+    loaded.
+
+    Args:
+        df (pandas dataframe): air quality dataframe
+    Returns:
+        intervals (dict): for each county with severe air quality, the
+            lists (haz_dates, haz_dates_offset, vh_dates,
+            vh_dates_offset) of subset_air_quality, with one entry per
+            run of days, the offset being the day after the run
+    """
+    _check_aq_columns(df)
+
+    severe = df.loc[df['AQI_Category'].isin(['Hazardous', 'Very Unhealthy']),
+                    ['County', 'AQI_Category', 'Date']]
+    severe = severe.astype({'County': object, 'AQI_Category': object})
+    severe = severe.sort_values(['County', 'AQI_Category', 'Date'])
+
+    county = severe['County'].to_numpy()
+    category = severe['AQI_Category'].to_numpy()
+    dates = severe['Date'].to_numpy(dtype='datetime64[D]')
+
+    # A run starts wherever the county or category changes or a day is
+    # skipped; repeated dates stay within their run.
+    new_county = county[1:] != county[:-1]
+    new_category = category[1:] != category[:-1]
+    skipped_day = dates[1:] - dates[:-1] > np.timedelta64(1, 'D')
+    starts = np.ones(len(dates), dtype=bool)
+    starts[1:] = new_county | new_category | skipped_day
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(dates)) - 1
+
+    run_starts = np.datetime_as_string(dates[first]).tolist()
+    run_ends = np.datetime_as_string(dates[last] + 1).tolist()
+
+    intervals = {}
+    for run, position in enumerate(first):
+        lists = intervals.setdefault(county[position], ([], [], [], []))
+        offset = 0 if category[position] == 'Hazardous' else 2
+        lists[offset].append(run_starts[run])
+        lists[offset + 1].append(run_ends[run])
+
+    return intervals
+
+
+def county_intervals(intervals, county_name):
+    """
+    Looks up the severe air quality intervals of the selected counties.
+
+    Args:
+        intervals (dict): output of severe_aq_intervals
+        county_name (list): names of counties selected from dropdown
+    Returns:
+        haz_dates (list): start of each hazardous interval
+        haz_dates_offset (list): day after each hazardous interval
+        vh_dates (list): start of each very unhealthy interval
+        vh_dates_offset (list): day after each very unhealthy interval
+    """
+    selected = ([], [], [], [])
+    for county in county_name:
+        if county in intervals:
+            for merged, county_list in zip(selected, intervals[county]):
+                merged.extend(county_list)
+
+    return selected
+
+
+def _check_aq_columns(df):
+    """
+    Checks that the air quality dataframe has county and category columns.
+
+    Args:
+        df (pandas dataframe): air quality dataframe
+    Raises:
+        ValueError: A county or AQI category column is missing
+    """
     if 'County' not in df.columns:
         raise ValueError('Air quality data is missing county information')
     if 'AQI_Category' not in df.columns:
         raise ValueError('Air quality data is missing EPA Categories')
 
-    vh_aq = df.loc[df['AQI_Category'] == 'Very Unhealthy']
-    haz_aq = df.loc[df['AQI_Category'] == 'Hazardous']
-    sub_vh_aq = vh_aq.loc[vh_aq['County'].isin(county_name)].copy()
-    sub_haz_aq = haz_aq.loc[haz_aq['County'].isin(county_name)].copy()
-    sub_vh_aq['Date offset'] = sub_vh_aq['Date'] + pd.DateOffset(days=1)
-    sub_haz_aq['Date offset'] = sub_haz_aq['Date'] + pd.DateOffset(days=1)
-
-    haz_dates = []
-    for date in sub_haz_aq['Date']:
-        new_date = str(date)
-        new_date = new_date.split()
-        new_date = new_date[0]
-        haz_dates.append(new_date)
-
-    haz_dates_offset = []
-    for date in sub_haz_aq['Date offset']:
-        new_date = str(date)
-        new_date = new_date.split()
-        new_date = new_date[0]
-        haz_dates_offset.append(new_date)
-
-    vh_dates_offset = []
-    for date in sub_vh_aq['Date offset']:
-        new_date = str(date)
-        new_date = new_date.split()
-        new_date = new_date[0]
-        vh_dates_offset.append(new_date)
-
-    vh_dates = []
-    for date in sub_vh_aq['Date']:
-        new_date = str(date)
-        new_date = new_date.split()
-        new_date = new_date[0]
-        vh_dates.append(new_date)
 
-    return haz_dates, haz_dates_offset, vh_dates, vh_dates_offset
+def build_count_cube(data_frame, taxa):
+    """
+    Sums the observation counts of the bird dataframe by taxon, county
+    and date for every taxonomic level, so that the count graph reads
+    a slice of precomputed sums instead of grouping the observations.
+
+    Args:
+        data_frame (pandas dataframe): bird dataframe with columns
+            county, observation date and observation count
+        taxa (list): taxonomic columns to sum by, e.g. 'common name',
+            'family' and 'order'
+    Returns:
+        count_cube (dict): for each taxonomic column, the sums under
+            'counts' sorted by county, taxon and date, the slice of
+            rows of each county under 'counties', and the sorted taxa
+            under 'order'
+    """
+    count_cube = {}
+    for taxonomy in taxa:
+        counts = data_frame.groupby(
+            ['county', taxonomy, 'observation date'],
+            observed=True)['observation count'].sum().reset_index()
+
+        county = counts['county'].to_numpy()
+        starts = np.flatnonzero(np.append(True, county[1:] != county[:-1]))
+        stops = np.append(starts[1:], len(county))
+
+        count_cube[taxonomy] = {
+            'counts': counts,
+            'counties': {county[start]: slice(start, stop)
+                         for start, stop in zip(starts, stops)},
+            'order': sorted(data_frame[taxonomy].dropna().unique()),
+        }
+
+    return count_cube
+
+
+def county_counts(count_cube, taxonomy, county_name):
+    """
+    Reads the observation counts of the selected counties, summed by
+    taxon and date, from the count cube.
+
+    Args:
+        count_cube (dict): output of build_count_cube
+        taxonomy (str): taxonomic column to sum by
+        county_name (list): names of counties selected from dropdown
+    Returns:
+        summed_obs_df (pandas dataframe): columns taxonomy, observation
+            date and observation count, sorted by taxon and date
+    """
+    cube = count_cube[taxonomy]
+    columns = [taxonomy, 'observation date', 'observation count']
+    parts = [cube['counts'].iloc[cube['counties'][county]]
+             for county in county_name if county in cube['counties']]
+
+    if len(parts) == 1:
+        summed_obs_df = parts[0][columns]
+    else:
+        parts.append(cube['counts'].iloc[0:0])
+        summed_obs_df = pd.concat(parts).groupby(
+            columns[:2], observed=True)[columns[2]].sum().reset_index()
+
+    return summed_obs_df.reset_index(drop=True)
+
+
+def _column_order(codes):
+    """
+    Returns the positions of rows sorted by their value codes, keeping
+    the row order within each value.
+    """
+
+    dtype = np.int32 if len(codes) < np.iinfo(np.int32).max else np.int64
+    return np.argsort(codes, kind='stable').astype(dtype)
@@ -0,0 +1,267 @@
+"""
+Typed, columnar binary copies of the phoenix datasets, so that the app
+and the KNN code do not re-parse csv files and dates on every start.
+
+A store is a directory holding one .npy file per column and a
+schema.json header. Dates are stored as datetime64, text columns as
+categorical codes with their categories in the header, and numbers in
+the width given by the schema. Columns are memory-mapped when loaded,
+and only the requested columns are opened.
+
+Functions:
+
+write_store(data, store_path, schema)
+    -- Writes a dataframe as a typed column store.
+
+convert_csv(csv_path, store_path, schema)
+    -- Converts a csv file to a typed column store.
+
+load_store(store_path, columns=None, mmap=True)
+    -- Loads (a subset of the columns of) a column store.
+
+read_table(csv_path, schema, columns=None)
+    -- Loads a dataset from its store, converting its csv first when
+       the store is missing or out of date.
+
+build_shared_store(store_path, schema, build, version='')
+    -- Builds a store once for all the processes that share it.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from phoenix.code.file_io import file_lock
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+SCHEMAS = {
+    'county_aq': {
+        'Date': 'datetime64[ns]',
+        'County': 'category',
+        'Avg_PM2.5': 'float64',
+        'AQI_Category': 'category',
+    },
+    'air_quality': {
+        'Date': 'datetime64[ns]',
+        'Avg_PM2.5': 'float64',
+        'Location_I': 'int32',
+        'Name': 'category',
+        'Latitude': 'float64',
+        'Longitude': 'float64',
+        'Category': 'category',
+    },
+    'ebird': {
+        'observation date': 'datetime64[ns]',
+        'common name': 'category',
+        'family': 'category',
+        'order': 'category',
+        'county': 'category',
+        'observation count': 'int32',
+        'latitude': 'float32',
+        'longitude': 'float32',
+    },
+}
+
+# Datasets converted by running this module, with their schema.
+DATASETS = {
+    'OR_DailyAQ_byCounty.csv': 'county_aq',
+    'Daily_Avg_PM2.5_Location.csv': 'air_quality',
+    'ebird_app_data.csv': 'ebird',
+}
+
+
+def write_store(data, store_path, schema, version=''):
+    """
+    Writes the schema columns of a dataframe as a typed column store,
+    replacing any existing store at the path.
+
+    Args:
+        data (pandas dataframe): data to store.
+        store_path (str): directory to write the store to.
+        schema (dict): dtype of each column to store, by name. Use
+            'category' for text columns and 'datetime64[ns]' for dates.
+        version (str): recorded in the header, to tell whether the
+            store is up to date with its sources.
+
+    Returns:
+        header (dict): the schema.json header of the store.
+
+    Raises:
+        KeyError: If a schema column is missing from the data.
+        ValueError: If a column cannot be cast to its schema dtype.
+    """
+
+    parent = os.path.dirname(os.path.abspath(store_path))
+    staging = tempfile.mkdtemp(dir=parent, prefix='.store-')
+    header = {'n_rows': len(data), 'version': version, 'columns': []}
+
+    try:
+        for position, (name, dtype) in enumerate(schema.items()):
+            column = data[name]
+            entry = {'name': name, 'file': f'col{position}.npy',
+                     'dtype': dtype}
+
+            if dtype == 'category':
+                column = column.astype('category')
+                entry['categories'] = column.cat.categories.tolist()
+                values = column.cat.codes.to_numpy()
+            elif dtype.startswith('datetime64'):
+                values = pd.to_datetime(column).to_numpy().astype(dtype)
+            else:
+                values = column.to_numpy().astype(dtype)
+
+            np.save(os.path.join(staging, entry['file']), values)
+            header['columns'].append(entry)
+
+        with open(os.path.join(staging, 'schema.json'), 'w') as header_file:
+            json.dump(header, header_file, indent=1)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    # Move the old store aside before swapping in the complete one, as
+    # a directory cannot be replaced by another. Readers that already
+    # mapped the old columns keep them; processes sharing a store should
+    # still write and read it under file_lock, as read_table does.
+    old_store = None
+    if os.path.isdir(store_path):
+        old_store = tempfile.mkdtemp(dir=parent, prefix='.store-old-')
+        os.replace(store_path, os.path.join(old_store, 'store'))
+    os.replace(staging, store_path)
+    if old_store is not None:
+        shutil.rmtree(old_store, ignore_errors=True)
+
+    return header
+
+
+def convert_csv(csv_path, store_path, schema):
+    """
+    Converts a csv file to a typed column store.
+
+    Args:
+        csv_path (str): csv file to convert.
+        store_path (str): directory to write the store to.
+        schema (dict): dtype of each column to store, by name.
+
+    Returns:
+        data (pandas dataframe): the converted data, as stored.
+    """
+
+    data = pd.read_csv(csv_path, usecols=list(schema))
+    write_store(data, store_path, schema)
+
+    return load_store(store_path)
+
+
+def load_store(store_path, columns=None, mmap=True):
+    """
+    Loads a typed column store. Only the requested columns are opened,
+    and with mmap their values are read from the page cache on use
+    rather than copied into memory at load. This needs pandas 2 or
+    later: older versions consolidate columns of the same dtype into
+    copies.
+
+    Args:
+        store_path (str): directory of the store.
+        columns (list): names of the columns to load, by default all
+            columns in stored order.
+        mmap (bool): memory-map the column files read-only.
+
+    Returns:
+        data (pandas dataframe): the stored data.
+
+    Raises:
+        KeyError: If a requested column is not in the store.
+    """
+
+    with open(os.path.join(store_path, 'schema.json')) as header_file:
+        header = json.load(header_file)
+
+    entries = {entry['name']: entry for entry in header['columns']}
+    if columns is None:
+        columns = list(entries)
+
+    data = {}
+    for name in columns:
+        entry = entries[name]
+        values = np.load(os.path.join(store_path, entry['file']),
+                         mmap_mode='r' if mmap else None)
+        if entry['dtype'] == 'category':
+            values = pd.Categorical.from_codes(values, entry['categories'])
+        data[name] = values
+
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+def read_table(csv_path, schema, columns=None, store_path=None):
+    """
+    Loads a dataset from its column store, (re-)converting the csv first
+    when the store is missing or older than the csv.
+
+    Args:
+        csv_path (str): csv file of the dataset.
+        schema (dict): dtype of each column, by name.
+        columns (list): names of the columns to load, by default all
+            schema columns.
+        store_path (str): directory of the store, by default the csv
+            path with '.store' in place of '.csv'.
+
+    Returns:
+        data (pandas dataframe): the typed data.
+    """
+
+    if store_path is None:
+        store_path = os.path.splitext(csv_path)[0] + '.store'
+    header_path = os.path.join(store_path, 'schema.json')
+
+    # Web server workers start together, so only one of them converts
+    # the csv while the others wait to load the new store.
+    with file_lock(store_path):
+        if not os.path.exists(header_path):
+            stale = True
+        else:
+            stale = os.path.getmtime(header_path) < os.path.getmtime(csv_path)
+        if stale:
+            convert_csv(csv_path, store_path, schema)
+
+        return load_store(store_path, columns)
+
+
+def build_shared_store(store_path, schema, build, version=''):
+    """
+    Builds a column store unless it already exists with the given
+    version. Many processes may call this at once, e.g. the workers of
+    a web server: one builds the store under a file lock while the
+    others wait, and all of them can then memory-map the same files
+    with load_store, sharing one copy of the data read-only.
+
+    Args:
+        store_path (str): directory of the store.
+        schema (dict): dtype of each column, by name.
+        build (function): returns the dataframe to store; only called
+            when the store is missing or out of date.
+        version (str): version of the data the store must hold.
+    """
+
+    with file_lock(store_path):
+        try:
+            with open(os.path.join(store_path, 'schema.json')) as header_file:
+                stored_version = json.load(header_file).get('version')
+        except (OSError, ValueError):
+            stored_version = None
+        if stored_version != version:
+            write_store(build(), store_path, schema, version)
+
+
+if __name__ == '__main__':
+    for csv_name, schema_name in DATASETS.items():
+        path = os.path.join(DATA_DIR, csv_name)
+        if os.path.exists(path):
+            store = os.path.splitext(path)[0] + '.store'
+            convert_csv(path, store, SCHEMAS[schema_name])
@@ -0,0 +1,651 @@
+"""
+Point-in-polygon lookups of GPS coordinates against the Oregon county
+geometry, backed by a grid index so that millions of points can be
+located at once.
+
+The grid covers the counties with square cells. Cells that no county
+boundary passes through are resolved once, when the index is built,
+to the county containing them (or to no county). Only points falling
+in cells crossed by a boundary need an exact, vectorized ray-casting
+test, only against the counties whose bounds overlap that cell, and
+only against the edges of those counties spanning the cell's row.
+
+The module also prepares simplified copies of the county geometry at
+several tolerances, for maps that do not need the full resolution.
+Borders are split into arcs between the points where counties meet,
+and each arc is simplified once, so neighboring counties keep sharing
+exactly the same border and no gaps or overlaps open up between them.
+
+Functions:
+
+load_county_geojson(path)
+    -- Reads the county geojson file.
+
+simplify_geojson(geojson, tolerance)
+    -- Simplifies the county polygons, preserving shared borders.
+
+build_simplified(path, tolerances)
+    -- Writes a simplified copy of the county geojson per tolerance.
+
+fetch_county_geojson(url, path, tolerances)
+    -- Downloads the county geojson and builds its simplified copies,
+       once for all the processes starting together.
+
+load_county_map(zoom, path)
+    -- Reads the lightest geometry that looks right at a map zoom.
+
+build_county_index(geojson, cell_size=0.05, name_key='altname')
+    -- Prepares the grid index over the county polygons.
+
+locate_points(county_index, latitude, longitude)
+    -- Finds the position of the county containing each point.
+
+assign_counties(county_index, latitude, longitude)
+    -- Finds the name of the county containing each point.
+"""
+
+import json
+import os
+from collections import defaultdict
+from urllib.request import urlopen
+
+import numpy as np
+
+from phoenix.code.file_io import atomic_file, file_lock
+
+
+COUNTY_GEOJSON = os.path.join(os.path.dirname(__file__), '..', 'data',
+                              'Oregon_counties_map.geojson')
+
+# Marks grid cells that a county boundary passes through.
+BOUNDARY = -2
+
+# Simplification tolerances in degrees of the prepared geometry levels.
+TOLERANCES = [0.01, 0.0025, 0.0006]
+
+# Width in degrees of a pixel of a web map at zoom 0 (512 pixel tiles).
+DEGREES_PER_PIXEL = 360 / 512
+
+
+def load_county_geojson(path=COUNTY_GEOJSON):
+    """
+    Reads the county geojson file.
+
+    Args:
+        path (str): location of the geojson file, by default the
+            Oregon county map in phoenix/data.
+
+    Returns:
+        geojson (dict): the parsed feature collection.
+    """
+
+    with open(path) as geojson_file:
+        return json.load(geojson_file)
+
+
+def simplify_geojson(geojson, tolerance):
+    """
+    Simplifies the polygons of a county geojson with Douglas-Peucker,
+    preserving the borders shared between counties.
+
+    Args:
+        geojson (dict): feature collection of Polygon or MultiPolygon
+            county features.
+        tolerance (float): largest distance in degrees a removed point
+            may lie from the simplified border.
+
+    Returns:
+        simplified (dict): a copy of the feature collection with
+            simplified geometry. Holes and islands smaller than the
+            tolerance are dropped.
+
+    Raises:
+        ValueError: If a feature is not a Polygon or MultiPolygon.
+    """
+
+    features = []
+    for feature in geojson['features']:
+        features.append([[_ring_points(ring) for ring in polygon]
+                         for polygon in _feature_polygons(feature['geometry'])])
+
+    # Points where more than two border segments meet split the borders
+    # into arcs, each shared by the same counties along its length.
+    neighbors = defaultdict(set)
+    for polygons in features:
+        for polygon in polygons:
+            for ring in polygon:
+                for i, point in enumerate(ring):
+                    neighbors[point].update((ring[i - 1],
+                                             ring[(i + 1) % len(ring)]))
+    junctions = {point for point, near in neighbors.items() if len(near) > 2}
+
+    arcs = {}
+    simplified = {'type': 'FeatureCollection', 'features': []}
+    for feature, polygons in zip(geojson['features'], features):
+        coordinates = []
+        for polygon in polygons:
+            rings = [_simplify_ring(ring, junctions, arcs, tolerance)
+                     for ring in polygon]
+            if rings[0] is None:
+                continue
+            coordinates.append([ring for ring in rings if ring is not None])
+
+        # Keep a county that would vanish at this tolerance unsimplified.
+        if len(coordinates) == 0:
+            coordinates = [[[list(point) for point in ring + [ring[0]]]
+                            for ring in polygon] for polygon in polygons]
+
+        simplified['features'].append({
+            'type': 'Feature',
+            'properties': feature['properties'],
+            'geometry': {'type': 'MultiPolygon', 'coordinates': coordinates},
+        })
+
+    return simplified
+
+
+def build_simplified(path=COUNTY_GEOJSON, tolerances=TOLERANCES):
+    """
+    Writes a simplified copy of a county geojson file for each
+    tolerance, next to the file.
+
+    Args:
+        path (str): location of the full resolution geojson file.
+        tolerances (list): simplification tolerances in degrees.
+
+    Returns:
+        paths (list): location of the simplified file of each tolerance.
+    """
+
+    geojson = load_county_geojson(path)
+    paths = []
+
+    for tolerance in tolerances:
+        simplified = simplify_geojson(geojson, tolerance)
+        simplified_path = _simplified_path(path, tolerance)
+        with atomic_file(simplified_path, 'w') as geojson_file:
+            json.dump(simplified, geojson_file, separators=(',', ':'))
+        paths.append(simplified_path)
+
+    return paths
+
+
+def fetch_county_geojson(url, path=COUNTY_GEOJSON, tolerances=TOLERANCES):
+    """
+    Downloads the full resolution county geojson and builds its
+    simplified copies, unless they are all present already. Processes
+    starting together, e.g. the workers of a web server, take turns
+    under a file lock, so the file is downloaded once; every file is
+    written whole and then moved into place, so none is read partially
+    written.
+
+    Args:
+        url (str): location of the geojson file to download.
+        path (str): location to store the full resolution file at.
+        tolerances (list): simplification tolerances in degrees.
+    """
+
+    paths = [path] + [_simplified_path(path, tolerance)
+                      for tolerance in tolerances]
+
+    with file_lock(path):
+        if not os.path.exists(path):
+            with urlopen(url) as response:
+                geojson = json.load(response)
+            with atomic_file(path, 'w') as geojson_file:
+                json.dump(geojson, geojson_file, separators=(',', ':'))
+        if not all(os.path.exists(level) for level in paths):
+            build_simplified(path, tolerances)
+
+
+def load_county_map(zoom, path=COUNTY_GEOJSON, tolerances=TOLERANCES):
+    """
+    Reads the lightest prepared county geometry whose simplification
+    stays below half a pixel at a web map zoom level, falling back to
+    the full resolution file.
+
+    Args:
+        zoom (float): zoom level of the map.
+        path (str): location of the full resolution geojson file.
+        tolerances (list): tolerances of the prepared levels.
+
+    Returns:
+        geojson (dict): the parsed feature collection.
+    """
+
+    half_pixel = DEGREES_PER_PIXEL / 2 ** zoom / 2
+    for tolerance in sorted(tolerances, reverse=True):
+        simplified_path = _simplified_path(path, tolerance)
+        if tolerance <= half_pixel and os.path.exists(simplified_path):
+            return load_county_geojson(simplified_path)
+
+    return load_county_geojson(path)
+
+
+def build_county_index(geojson, cell_size=0.05, name_key='altname'):
+    """
+    Prepares a grid index over the polygons of a county geojson.
+
+    Args:
+        geojson (dict): feature collection of Polygon or MultiPolygon
+            county features.
+        cell_size (float): width of the square grid cells in degrees.
+        name_key (str): feature property holding the county name.
+
+    Returns:
+        county_index (dict): the prepared index, with the county names
+            under 'names' in the same order as the features.
+
+    Raises:
+        ValueError: If a feature is not a Polygon or MultiPolygon.
+    """
+
+    names = []
+    edges = []
+    bounds = []
+
+    for feature in geojson['features']:
+        names.append(feature['properties'].get(name_key))
+        feature_edges = _feature_edges(feature['geometry'])
+        edges.append(feature_edges)
+        lon0, lat0, lon1, lat1 = feature_edges.T
+        bounds.append((min(lon0.min(), lon1.min()), min(lat0.min(), lat1.min()),
+                       max(lon0.max(), lon1.max()), max(lat0.max(), lat1.max())))
+
+    bounds = np.array(bounds)
+    origin = (bounds[:, 0].min() - cell_size, bounds[:, 1].min() - cell_size)
+    n_cols = int(np.ceil((bounds[:, 2].max() - origin[0]) / cell_size)) + 2
+    n_rows = int(np.ceil((bounds[:, 3].max() - origin[1]) / cell_size)) + 2
+
+    # Counties whose bounding box overlaps each cell.
+    candidates = np.zeros((n_rows * n_cols, len(names)), dtype=bool)
+    boundary = np.zeros((n_rows, n_cols), dtype=bool)
+    row_edges = []
+
+    for position, feature_edges in enumerate(edges):
+        col0, row0 = _cell(bounds[position, 0], bounds[position, 1],
+                           origin, cell_size)
+        col1, row1 = _cell(bounds[position, 2], bounds[position, 3],
+                           origin, cell_size)
+        box = np.zeros((n_rows, n_cols), dtype=bool)
+        box[row0:row1 + 1, col0:col1 + 1] = True
+        candidates[:, position] = box.ravel()
+        _mark_boundary(boundary, feature_edges, origin, cell_size)
+        row_edges.append(_bucket_rows(feature_edges, origin, cell_size))
+
+    county_index = {
+        'names': names,
+        'edges': edges,
+        'row_edges': row_edges,
+        'origin': origin,
+        'cell_size': cell_size,
+        'shape': (n_rows, n_cols),
+        'candidates': candidates,
+        'owner': np.full(n_rows * n_cols, BOUNDARY),
+    }
+
+    # Cells without a boundary lie wholly inside one county (or none),
+    # so the county containing the cell center holds for the full cell.
+    interior = np.flatnonzero(~boundary.ravel())
+    rows, cols = np.divmod(interior, n_cols)
+    centers_lon = origin[0] + (cols + 0.5) * cell_size
+    centers_lat = origin[1] + (rows + 0.5) * cell_size
+    county_index['owner'][interior] = _locate_exact(
+        county_index, interior, centers_lon, centers_lat)
+
+    return county_index
+
+
+def locate_points(county_index, latitude, longitude):
+    """
+    Finds the county containing each point.
+
+    Args:
+        county_index (dict): output of build_county_index.
+        latitude (array): latitude of each point.
+        longitude (array): longitude of each point.
+
+    Returns:
+        positions (numpy array): position of the containing county in
+            county_index['names'], or -1 for points outside every
+            county.
+    """
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    n_rows, n_cols = county_index['shape']
+
+    positions = np.full(len(latitude), -1)
+
+    cols, rows = _cell(longitude, latitude, county_index['origin'],
+                       county_index['cell_size'])
+    on_grid = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+    points = np.flatnonzero(on_grid)
+    cells = rows[points] * n_cols + cols[points]
+
+    owner = county_index['owner'][cells]
+    positions[points] = np.where(owner == BOUNDARY, -1, owner)
+
+    # Only points in cells crossed by a boundary need the exact test.
+    exact = owner == BOUNDARY
+    points = points[exact]
+    positions[points] = _locate_exact(county_index, cells[exact],
+                                      longitude[points], latitude[points])
+
+    return positions
+
+
+def assign_counties(county_index, latitude, longitude):
+    """
+    Finds the name of the county containing each point, e.g. to assign
+    counties to air quality stations or to eBird observations in bulk.
+
+    Args:
+        county_index (dict): output of build_county_index.
+        latitude (array): latitude of each point.
+        longitude (array): longitude of each point.
+
+    Returns:
+        counties (numpy array): name of the containing county, or None
+            for points outside every county.
+    """
+
+    names = np.array(county_index['names'] + [None], dtype=object)
+
+    # Position -1 of points outside every county selects the None.
+    return names[locate_points(county_index, latitude, longitude)]
+
+
+def _feature_polygons(geometry):
+    """
+    Returns the polygons of a Polygon or MultiPolygon geometry.
+
+    Raises:
+        ValueError: If the geometry is not a Polygon or MultiPolygon.
+    """
+
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+
+
+def _feature_edges(geometry):
+    """
+    Collects every edge of every ring of a Polygon or MultiPolygon.
+
+    Args:
+        geometry (dict): geojson geometry.
+
+    Returns:
+        edges (numpy array): rows of (lon0, lat0, lon1, lat1).
+
+    Raises:
+        ValueError: If the geometry is not a Polygon or MultiPolygon.
+    """
+
+    edges = []
+    for polygon in _feature_polygons(geometry):
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=float)[:, :2]
+            edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+
+    return np.vstack(edges)
+
+
+def _ring_points(ring):
+    """
+    Returns the distinct consecutive points of a closed geojson ring as
+    (lon, lat) tuples, without repeating the first point at the end.
+    """
+
+    points = []
+    for coordinate in ring:
+        point = (float(coordinate[0]), float(coordinate[1]))
+        if len(points) == 0 or point != points[-1]:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+
+    return points
+
+
+def _simplify_ring(ring, junctions, arcs, tolerance):
+    """
+    Simplifies a ring arc by arc, reusing the arcs already simplified
+    for neighboring rings.
+
+    Args:
+        ring (list): distinct (lon, lat) points of the ring.
+        junctions (set): points where the ring may be split.
+        arcs (dict): simplified arcs, by their points in canonical
+            direction; updated in place.
+        tolerance (float): simplification tolerance in degrees.
+
+    Returns:
+        coordinates (list): the closed simplified ring, or None if it
+            collapses to fewer than three points.
+    """
+
+    splits = [i for i, point in enumerate(ring) if point in junctions]
+    if len(splits) == 0:
+        # A ring meeting no other starts at its smallest point, so that
+        # a neighbor tracing the same ring splits it identically.
+        splits = [ring.index(min(ring))]
+
+    start = splits[0]
+    ring = ring[start:] + ring[:start]
+    splits = [i - start for i in splits] + [len(ring)]
+    ring = ring + [ring[0]]
+
+    coordinates = []
+    for first, last in zip(splits[:-1], splits[1:]):
+        arc = tuple(ring[first:last + 1])
+        canonical = min(arc, arc[::-1])
+        if canonical not in arcs:
+            arcs[canonical] = _douglas_peucker(np.array(canonical), tolerance)
+        simplified = arcs[canonical]
+        if canonical != arc:
+            simplified = simplified[::-1]
+        coordinates.extend(simplified[:-1].tolist())
+
+    if len(coordinates) < 3:
+        return None
+    return coordinates + [coordinates[0]]
+
+
+def _douglas_peucker(points, tolerance):
+    """
+    Simplifies a line with the Douglas-Peucker algorithm, keeping its
+    end points.
+
+    Args:
+        points (numpy array): rows of (x, y).
+        tolerance (float): largest distance a removed point may lie
+            from the simplified line.
+
+    Returns:
+        simplified (numpy array): the kept rows of points.
+    """
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distance = _segment_distance(points[first + 1:last], points[first],
+                                     points[last])
+        farthest = np.argmax(distance)
+        if distance[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.extend([(first, middle), (middle, last)])
+
+    return points[keep]
+
+
+def _segment_distance(points, start, stop):
+    """
+    Returns the distance of each point to the segment from start to stop.
+    """
+
+    segment = stop - start
+    length = segment @ segment
+    if length == 0:
+        along = np.zeros(len(points))
+    else:
+        along = np.clip((points - start) @ segment / length, 0, 1)
+    nearest = start + along[:, None] * segment
+
+    return np.hypot(*(points - nearest).T)
+
+
+def _simplified_path(path, tolerance):
+    """
+    Returns the location of the simplified copy of a geojson file.
+    """
+
+    stem, extension = os.path.splitext(path)
+    return f'{stem}_{tolerance:g}{extension}'
+
+
+def _cell(longitude, latitude, origin, cell_size):
+    """
+    Returns the (column, row) of the grid cell holding each point.
+    """
+
+    cols = np.floor((np.asarray(longitude) - origin[0]) / cell_size)
+    rows = np.floor((np.asarray(latitude) - origin[1]) / cell_size)
+
+    return cols.astype(int), rows.astype(int)
+
+
+def _mark_boundary(boundary, edges, origin, cell_size):
+    """
+    Flags every grid cell overlapped by the bounding box of an edge.
+
+    Args:
+        boundary (numpy array): boolean grid, updated in place.
+        edges (numpy array): rows of (lon0, lat0, lon1, lat1).
+        origin (tuple): (longitude, latitude) of the grid corner.
+        cell_size (float): width of the grid cells in degrees.
+    """
+
+    col0, row0 = _cell(np.minimum(edges[:, 0], edges[:, 2]),
+                       np.minimum(edges[:, 1], edges[:, 3]),
+                       origin, cell_size)
+    col1, row1 = _cell(np.maximum(edges[:, 0], edges[:, 2]),
+                       np.maximum(edges[:, 1], edges[:, 3]),
+                       origin, cell_size)
+
+    # Most edges are short and stay within a single cell.
+    single = (col0 == col1) & (row0 == row1)
+    boundary[row0[single], col0[single]] = True
+
+    for i in np.flatnonzero(~single):
+        boundary[row0[i]:row1[i] + 1, col0[i]:col1[i] + 1] = True
+
+
+def _bucket_rows(edges, origin, cell_size):
+    """
+    Buckets the edges of a county by the grid rows their latitudes span.
+    A horizontal ray cast from a point can only cross edges spanning the
+    point's own latitude, which all lie in the bucket of its row.
+
+    Args:
+        edges (numpy array): rows of (lon0, lat0, lon1, lat1).
+        origin (tuple): (longitude, latitude) of the grid corner.
+        cell_size (float): width of the grid cells in degrees.
+
+    Returns:
+        buckets (dict): the edges spanning each grid row, by row.
+    """
+
+    _, row0 = _cell(edges[:, 0], np.minimum(edges[:, 1], edges[:, 3]),
+                    origin, cell_size)
+    _, row1 = _cell(edges[:, 0], np.maximum(edges[:, 1], edges[:, 3]),
+                    origin, cell_size)
+
+    buckets = {}
+    for row in range(row0.min(), row1.max() + 1):
+        buckets[row] = edges[(row0 <= row) & (row <= row1)]
+
+    return buckets
+
+
+def _locate_exact(county_index, cells, longitude, latitude):
+    """
+    Tests points exactly against the counties whose bounding box
+    overlaps their grid cell.
+
+    Args:
+        county_index (dict): output of build_county_index.
+        cells (numpy array): flat grid cell of each point.
+        longitude (numpy array): longitude of each point.
+        latitude (numpy array): latitude of each point.
+
+    Returns:
+        positions (numpy array): position of the containing county,
+            or -1 for points outside every county.
+    """
+
+    positions = np.full(len(cells), -1)
+    rows = cells // county_index['shape'][1]
+
+    for position, buckets in enumerate(county_index['row_edges']):
+        candidate = county_index['candidates'][cells, position]
+        points = np.flatnonzero(candidate & (positions == -1))
+
+        # Test the points of each grid row against that row's edges.
+        points = points[np.argsort(rows[points], kind='stable')]
+        point_rows, starts = np.unique(rows[points], return_index=True)
+        bounds = np.append(starts, len(points))
+
+        for i, row in enumerate(point_rows):
+            row_points = points[bounds[i]:bounds[i + 1]]
+            edges = buckets.get(row)
+            if edges is None or len(edges) == 0:
+                continue
+            inside = _in_polygon(edges, longitude[row_points],
+                                 latitude[row_points])
+            positions[row_points[inside]] = position
+
+    return positions
+
+
+def _in_polygon(edges, x, y, block=4096):
+    """
+    Even-odd ray casting of points against the edges of a polygon,
+    vectorized over blocks of points.
+
+    Args:
+        edges (numpy array): rows of (x0, y0, x1, y1).
+        x (numpy array): x coordinate (longitude) of each point.
+        y (numpy array): y coordinate (latitude) of each point.
+        block (int): number of points tested at a time.
+
+    Returns:
+        inside (numpy array): boolean, True for points in the polygon.
+    """
+
+    x0, y0, x1, y1 = edges.T
+    inside = np.zeros(len(x), dtype=bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(x), block):
+            px = x[start:start + block, None]
+            py = y[start:start + block, None]
+            straddles = (y0 > py) != (y1 > py)
+            crossing = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            crosses = straddles & (px < crossing)
+            inside[start:start + block] = crosses.sum(axis=1) % 2 == 1
+
+    return inside
+
+
+if __name__ == '__main__':
+    build_simplified()
@@ -1,72 +1,251 @@
 '''
 Assign counties and aqi category to air quality data for use in dash app.
 
+Importing this module does no I/O. The county dataset used by the app,
+OR_DailyAQ_byCounty.csv, is built from the local station data with:
+
+    python -m phoenix.code.data_cleaning
+
 Functions:
 
-    assign_aqicat(data)
+    assign_aqicat(data, aqi=False)
+    aqi_category(pm25)
+    aqi_value(pm25)
+    county_daily_aq(air_quality, station_counties)
+    impute_counties(county_aq, donors=DONOR_COUNTIES)
+    locate_stations(air_quality, county_index)
+    build_county_aq(air_path, counties_path, output_path, county_index=None)
 '''
 
 # Import packages
+import json
+import os
+import hashlib
+import warnings
+
+import numpy as np
 import pandas as pd
 
-# import air quality and county data
-
-air_quality = pd.read_csv("https://raw.githubusercontent.com/emilysellinger/Phoenix.github.io/main/phoenix/data/Daily_Avg_PM2.5_Location.csv")  # noqa
-air_quality.head()
-station_counties = pd.read_csv("https://raw.githubusercontent.com/emilysellinger/Phoenix.github.io/main/phoenix/data/ORAQ_StationCounties.csv")  # noqa
-station_counties.head()
-
-# Assign county values to air quality station readings by shared name
-aq = air_quality.join(station_counties.set_index('Name'), on='Name')
-aq.head()
-
-# Calculate mean daily PM2.5 reading for counties with multiple stations
-cols = ['Date', 'County']
-county_aq = aq.groupby(cols, as_index=False)['Avg_PM2.5'].mean()
-county_aq.head()
-
-# Assign PM2.5 values for counties without stations to nearest county
-# and append to dataframe with county means.
-coos = county_aq[county_aq['County'] == 'Douglas']
-coos = coos.replace(['Douglas'], 'Coos')
-curry = county_aq[county_aq['County'] == 'Josephine']
-curry = curry.replace(['Josephine'], 'Curry')
-malheur = county_aq[county_aq['County'] == 'Harney']
-malheur = malheur.replace(['Harney'], 'Malheur')
-morrow = county_aq[county_aq['County'] == 'Umatilla']
-morrow = morrow.replace(['Umatilla'], 'Morrow')
-gilliam = county_aq[county_aq['County'] == 'Umatilla']
-gilliam = gilliam.replace(['Umatilla'], 'Gilliam')
-wheeler = county_aq[county_aq['County'] == 'Grant']
-wheeler = wheeler.replace(['Grant'], 'Wheeler')
-sherman = county_aq[county_aq['County'] == 'Wasco']
-sherman = sherman.replace(['Wasco'], 'Sherman')
-hood_river = county_aq[county_aq['County'] == 'Wasco']
-hood_river = hood_river.replace(['Wasco'], 'Hood River')
-columbia = county_aq[county_aq['County'] == 'Washington']
-columbia = columbia.replace(['Washington'], 'Columbia')
-clatsop = county_aq[county_aq['County'] == 'Washington']
-clatsop = clatsop.replace(['Washington'], 'Clatsop')
-tillamook = county_aq[county_aq['County'] == 'Washington']
-tillamook = tillamook.replace(['Washington'], 'Tillamook')
-yamhill = county_aq[county_aq['County'] == 'Washington']
-yamhill = yamhill.replace(['Washington'], 'Yamhill')
-polk = county_aq[county_aq['County'] == 'Marion']
-polk = polk.replace(['Marion'], 'Polk')
-lincoln = county_aq[county_aq['County'] == 'Benton']
-lincoln = lincoln.replace(['Benton'], 'Lincoln')
-or_counties = county_aq.append([coos, curry, malheur, morrow,
-                               gilliam, wheeler, sherman, hood_river,
-                               columbia, clatsop, tillamook, yamhill,
-                               polk, lincoln])
-
-
-def assign_aqicat(data):
+from phoenix.code import county_geometry
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+AIR_QUALITY_CSV = os.path.join(DATA_DIR, 'Daily_Avg_PM2.5_Location.csv')
+STATION_COUNTIES_CSV = os.path.join(DATA_DIR, 'ORAQ_StationCounties.csv')
+COUNTY_AQ_CSV = os.path.join(DATA_DIR, 'OR_DailyAQ_byCounty.csv')
+
+# Nearest county with a station, for each county without one.
+DONOR_COUNTIES = {'Coos': 'Douglas', 'Curry': 'Josephine',
+                  'Malheur': 'Harney', 'Morrow': 'Umatilla',
+                  'Gilliam': 'Umatilla', 'Wheeler': 'Grant',
+                  'Sherman': 'Wasco', 'Hood River': 'Wasco',
+                  'Columbia': 'Washington', 'Clatsop': 'Washington',
+                  'Tillamook': 'Washington', 'Yamhill': 'Washington',
+                  'Polk': 'Marion', 'Lincoln': 'Benton'}
+
+# EPA AQI categories of daily PM2.5, in increasing order of concern.
+AQI_CATEGORIES = ['Good', 'Moderate', 'Unhealthy for Sensitive Groups',
+                  'Unhealthy', 'Very Unhealthy', 'Hazardous']
+
+# Lowest PM2.5 (ug/m3) of each category above 'Good'.
+AQI_THRESHOLDS = np.array([12.1, 35.5, 55.5, 150.5, 250.5])
+
+# EPA PM2.5 breakpoints: (C_low, C_high, I_low, I_high) of each segment.
+PM25_BREAKPOINTS = np.array([[0.0, 12.0, 0, 50],
+                             [12.1, 35.4, 51, 100],
+                             [35.5, 55.4, 101, 150],
+                             [55.5, 150.4, 151, 200],
+                             [150.5, 250.4, 201, 300],
+                             [250.5, 350.4, 301, 400],
+                             [350.5, 500.4, 401, 500]])
+
+
+def county_daily_aq(air_quality, station_counties):
+    '''
+    Returns the daily PM2.5 of each county, including counties without
+    stations, with categorical AQI ratings assigned.
+
+        Parameters:
+                air_quality (dataframe): daily station PM2.5 readings
+                    with columns (Date, Name, Avg_PM2.5)
+                station_counties (dataframe): county of each station
+                    with columns (Name, County)
+
+        Returns:
+                or_counties (dataframe): columns (Date, County,
+                    Avg_PM2.5, AQI_Category), sorted by date and county
+    '''
+    # Assign county values to air quality station readings by shared name
+    aq = air_quality.join(station_counties.set_index('Name'), on='Name')
+
+    # Calculate mean daily PM2.5 reading for counties with multiple stations
+    cols = ['Date', 'County']
+    county_aq = aq.groupby(cols, as_index=False)['Avg_PM2.5'].mean()
+
+    or_counties = impute_counties(county_aq)
+    or_counties = or_counties.sort_values(cols, kind='stable')
+    or_counties = or_counties.reset_index(drop=True)
+
+    return assign_aqicat(or_counties)
+
+
+def impute_counties(county_aq, donors=DONOR_COUNTIES):
+    '''
+    Assigns PM2.5 values for counties without stations to nearest county
+    and appends them to the dataframe with county means. All counties
+    are filled with a single merge against the donor table.
+
+        Parameters:
+                county_aq (dataframe): daily mean PM2.5 of the counties
+                    with stations
+                donors (dict): county with a station to copy the values
+                    of, for each county without one
+
+        Returns:
+                or_counties (dataframe): county_aq with rows added for
+                    the counties without stations
+    '''
+    donor_table = pd.DataFrame({'County': list(donors.keys()),
+                                'Donor': list(donors.values())})
+
+    imputed = county_aq.merge(donor_table, left_on='County',
+                              right_on='Donor', suffixes=('_donor', ''))
+    imputed = imputed[county_aq.columns]
+
+    or_counties = pd.concat([county_aq, imputed], ignore_index=True)
+    return or_counties
+
+
+def locate_stations(air_quality, county_index):
+    '''
+    Returns the county of each station, found from its coordinates by a
+    point-in-polygon lookup, so new stations need no manual table entry.
+
+        Parameters:
+                air_quality (dataframe): station readings with columns
+                    (Name, Latitude, Longitude)
+                county_index (dict): output of
+                    county_geometry.build_county_index
+
+        Returns:
+                station_counties (dataframe): columns (Name, County),
+                    without the stations outside every county
+
+        Warnings:
+                UserWarning: names the stations outside every county
+    '''
+    stations = air_quality[['Name', 'Latitude', 'Longitude']]
+    stations = stations.drop_duplicates('Name')
+    counties = county_geometry.assign_counties(
+        county_index, stations['Latitude'], stations['Longitude'])
+
+    station_counties = pd.DataFrame({'Name': stations['Name'].to_numpy(),
+                                     'County': counties})
+    outside = station_counties['County'].isna()
+    if outside.any():
+        names = ', '.join(station_counties['Name'][outside])
+        warnings.warn(f"Stations outside every county: {names}")
+
+    return station_counties[~outside].reset_index(drop=True)
+
+
+def build_county_aq(air_path=AIR_QUALITY_CSV,
+                    counties_path=STATION_COUNTIES_CSV,
+                    output_path=COUNTY_AQ_CSV, county_index=None):
+    '''
+    Builds the county daily air quality dataset from the local station
+    files and writes it as csv. A manifest of the station input of each
+    date is stored next to the output, so that a rebuild re-aggregates
+    only the dates whose station readings changed and reuses the rest
+    of the existing output. Changing the station counties rebuilds all
+    dates.
+
+        Parameters:
+                air_path (str): csv of daily station PM2.5 readings
+                counties_path (str): csv of the county of each station
+                output_path (str): csv to write the county dataset to
+                county_index (dict): county geometry index; when given,
+                    station counties are located from the station
+                    coordinates instead of read from counties_path
+
+        Returns:
+                dates (list): the dates that were (re-)aggregated
+    '''
+    air_quality = pd.read_csv(air_path)
+    if county_index is None:
+        station_counties = pd.read_csv(counties_path).dropna(how='all')
+    else:
+        station_counties = locate_stations(air_quality, county_index)
+
+    manifest_path = output_path + '.manifest.json'
+    manifest = {'counties': _frame_digest(station_counties),
+                'dates': _date_digests(air_quality)}
+
+    previous = {}
+    if os.path.exists(output_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            previous = json.load(manifest_file)
+    if previous.get('counties') != manifest['counties']:
+        previous = {}
+
+    old_dates = previous.get('dates', {})
+    dates = [date for date, digest in manifest['dates'].items()
+             if old_dates.get(date) != digest]
+
+    if len(dates) == 0 and old_dates.keys() == manifest['dates'].keys():
+        return dates
+
+    changed = air_quality[air_quality['Date'].isin(dates)]
+    or_counties = county_daily_aq(changed, station_counties)
+
+    # Keep the existing rows of the dates that did not change.
+    if old_dates:
+        kept = pd.read_csv(output_path, keep_default_na=False, na_values=[''])
+        unchanged = ~kept['Date'].isin(dates)
+        kept = kept[kept['Date'].isin(manifest['dates']) & unchanged]
+        or_counties = pd.concat([kept[or_counties.columns], or_counties])
+        or_counties = or_counties.sort_values(['Date', 'County'], kind='stable')
+
+    or_counties.to_csv(output_path, index=False)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+    return dates
+
+
+def _date_digests(air_quality):
+    '''
+    Returns a digest of the station readings of each date, independent of
+    the order of the rows.
+    '''
+    readings = air_quality[['Date', 'Name', 'Avg_PM2.5']]
+    row_hashes = pd.util.hash_pandas_object(readings, index=False).to_numpy()
+
+    order = np.argsort(readings['Date'].to_numpy(), kind='stable')
+    dates, starts = np.unique(readings['Date'].to_numpy()[order],
+                              return_index=True)
+    sums = np.add.reduceat(row_hashes[order], starts)
+    counts = np.diff(np.append(starts, len(order)))
+
+    return {str(date): f'{total:016x}-{count}'
+            for date, total, count in zip(dates, sums, counts)}
+
+
+def _frame_digest(data):
+    '''
+    Returns a digest of the full contents of a dataframe.
+    '''
+    row_hashes = pd.util.hash_pandas_object(data, index=False)
+    return hashlib.sha256(row_hashes.to_numpy().tobytes()).hexdigest()
+
+
+def assign_aqicat(data, aqi=False):
     '''
     Returns a dataset of PM2.5 values with categorical AQI ratings assigned.
 
         Parameters:
                 data (array): Dataframe with column of daily avg PM2.5 values
+                aqi (bool): also append the numeric AQI as column 'AQI'
 
         Returns:
                 data (array): Dataframe with AQI ratings appended as new column
@@ -74,28 +253,56 @@ def assign_aqicat(data):
     if data['Avg_PM2.5'].dtype != 'float64':
         raise ValueError("Provided PM 2.5 ratings are not floating point values")
 
-    aqi_cat = []
-
-    for row in data['Avg_PM2.5']:
-        if row >= 250.5:
-            aqi_cat.append('Hazardous')
-        elif row >= 150.5:
-            aqi_cat.append('Very Unhealthy')
-        elif row >= 55.5:
-            aqi_cat.append('Unhealthy')
-        elif row >= 35.5:
-            aqi_cat.append('Unhealthy for Sensitive Groups')
-        elif row >= 12.1:
-            aqi_cat.append('Moderate')
-        elif row < 12.1:
-            aqi_cat.append('Good')
-        else:
-            aqi_cat.append('NA')
-    data['AQI_Category'] = aqi_cat
+    aqi_cat = aqi_category(data['Avg_PM2.5'])
+    data['AQI_Category'] = np.asarray(aqi_cat.add_categories('NA').fillna('NA'),
+                                      dtype=object)
+    if aqi:
+        data['AQI'] = aqi_value(data['Avg_PM2.5'])
     return data
 
 
-# Can use the following code to append AQI categories
-# to county daily PM2.5 dataframe and download that dataframe as csv.
-# assign_aqicat(or_counties)
-# or_counties.to_csv("../data/OR_DailyAQ_byCounty.csv")
+def aqi_category(pm25):
+    '''
+    Classifies PM2.5 values into AQI categories in a single vectorized
+    pass, so it can be applied to arrays or chunks of streamed data.
+
+        Parameters:
+                pm25 (array): PM2.5 values in ug/m3
+
+        Returns:
+                categories (categorical): ordered categorical of the
+                    AQI_CATEGORIES, missing for NaN values
+    '''
+    pm25 = np.asarray(pm25, dtype=float)
+    codes = np.searchsorted(AQI_THRESHOLDS, pm25, side='right')
+    codes[np.isnan(pm25)] = -1
+
+    return pd.Categorical.from_codes(codes, AQI_CATEGORIES, ordered=True)
+
+
+def aqi_value(pm25):
+    '''
+    Computes the EPA numeric AQI of PM2.5 values, interpolated linearly
+    within the breakpoint segment of each value. Concentrations are
+    truncated to 0.1 ug/m3 first, as the EPA specifies, and values
+    above the top breakpoint are reported as 500.
+
+        Parameters:
+                pm25 (array): PM2.5 values in ug/m3
+
+        Returns:
+                aqi (numpy array): AQI of each value, NaN for NaN values
+    '''
+    pm25 = np.asarray(pm25, dtype=float)
+    conc = np.floor(pm25 * 10 + 1e-9) / 10
+    conc = np.clip(conc, 0, PM25_BREAKPOINTS[-1, 1])
+
+    segment = np.searchsorted(PM25_BREAKPOINTS[1:, 0], conc, side='right')
+    c_low, c_high, i_low, i_high = PM25_BREAKPOINTS[segment].T
+    aqi = (i_high - i_low) / (c_high - c_low) * (conc - c_low) + i_low
+
+    return np.round(aqi)
+
+
+if __name__ == '__main__':
+    build_county_aq()
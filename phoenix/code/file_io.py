@@ -0,0 +1,71 @@
+"""
+File writing shared by processes running at the same time, e.g. the
+workers of a web server that start together or a knn run in several
+processes: exclusive locks across processes, and files that only
+appear once they are completely written.
+
+Functions:
+
+file_lock(path)
+    -- Holds an exclusive lock on a path across processes.
+
+atomic_file(path, mode='wb')
+    -- Opens a file that replaces path only once it is fully written.
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on a path across processes, through a lock
+    file next to it, while the with block runs. Without fcntl (on
+    Windows, where the app runs as a single process) no lock is taken.
+
+    Args:
+        path (str): file or directory to lock; need not exist.
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def atomic_file(path, mode='wb'):
+    """
+    Opens a temporary file in the directory of path, and moves it to
+    path once the with block completes, so readers find either the old
+    file or the complete new one. If the block raises, the temporary
+    file is removed and the error re-raised.
+
+    Args:
+        path (str): file to write.
+        mode (str): 'wb' for bytes or 'w' for text.
+
+    Yields:
+        file: the open temporary file.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, mode) as temp_file:
+            yield temp_file
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,227 @@
+"""
+Streaming ingestion of hourly PM2.5 station records into the daily
+station averages of Daily_Avg_PM2.5_Location.csv.
+
+The ingestion keeps running daily aggregates per station: the sum of
+the hourly readings, the number of hours seen, and a bit mask of which
+hours those were. New hourly records are folded into the aggregates as
+they arrive, so appending an hour never re-reads earlier data, and an
+hour that is delivered twice is only counted once. As in the original
+hand-made dataset, a daily average is only reported for days with all
+24 hours present; other days are listed as missing.
+
+Hourly records are dataframes (or csv files) with the columns
+Location_I (station id), Datetime (time of the reading) and PM2.5.
+
+Functions:
+
+empty_state()
+    -- Returns running aggregates holding no data.
+
+ingest_hourly(state, records)
+    -- Folds a batch of hourly records into the running aggregates.
+
+stream_hourly_csv(path, state=None, chunksize=100000)
+    -- Folds an hourly csv file into the running aggregates in chunks.
+
+daily_averages(state, stations)
+    -- Returns the daily station averages with their AQI category.
+
+save_state(state, path) / load_state(path)
+    -- Store the running aggregates between ingestion runs.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from phoenix.code import column_store
+from phoenix.code.data_cleaning import aqi_category
+
+
+HOURS_PER_DAY = 24
+
+STATE_SCHEMA = {
+    'Location_I': 'int64',
+    'Date': 'datetime64[ns]',
+    'Total': 'float64',
+    'Hours': 'int64',
+    'Mask': 'int64',
+}
+
+DAILY_COLUMNS = ['Date', 'Avg_PM2.5', 'Location_I', 'Name', 'Latitude',
+                 'Longitude', 'Category']
+
+
+def empty_state():
+    """
+    Returns running daily aggregates holding no data.
+
+    Returns:
+        state (pandas dataframe): columns Total, Hours and Mask, indexed
+            by (Location_I, Date).
+    """
+
+    index = pd.MultiIndex.from_arrays(
+        [np.array([], dtype='int64'), np.array([], dtype='datetime64[ns]')],
+        names=['Location_I', 'Date'])
+
+    return pd.DataFrame({'Total': np.array([], dtype='float64'),
+                         'Hours': np.array([], dtype='int64'),
+                         'Mask': np.array([], dtype='int64')}, index=index)
+
+
+def ingest_hourly(state, records):
+    """
+    Folds a batch of hourly station records into the running daily
+    aggregates. Readings are attributed to the hour they fall in;
+    missing readings and hours already aggregated are skipped.
+
+    Args:
+        state (pandas dataframe): running aggregates, from empty_state,
+            load_state or a previous call.
+        records (pandas dataframe): hourly readings with columns
+            Location_I, Datetime and PM2.5.
+
+    Returns:
+        state (pandas dataframe): the updated aggregates.
+    """
+
+    times = pd.to_datetime(records['Datetime']).dt.floor('h')
+    hourly = pd.DataFrame({
+        'Location_I': records['Location_I'].to_numpy(dtype='int64'),
+        'Date': times.dt.normalize().to_numpy(),
+        'Hour': times.dt.hour.to_numpy(dtype='int64'),
+        'PM2.5': records['PM2.5'].to_numpy(dtype='float64'),
+    })
+    hourly = hourly[np.isfinite(hourly['PM2.5'].to_numpy())]
+    hourly = hourly.drop_duplicates(['Location_I', 'Date', 'Hour'])
+
+    # Skip hours that earlier batches already aggregated.
+    bits = np.left_shift(np.int64(1), hourly['Hour'].to_numpy())
+    keys = pd.MultiIndex.from_frame(hourly[['Location_I', 'Date']])
+    seen = state['Mask'].reindex(keys, fill_value=0).to_numpy()
+    new = (seen & bits) == 0
+
+    hourly = hourly[new].assign(Hours=1, Mask=bits[new])
+    daily = hourly.groupby(['Location_I', 'Date']).agg(
+        Total=('PM2.5', 'sum'), Hours=('Hours', 'sum'), Mask=('Mask', 'sum'))
+
+    # The masks of an old and a new batch never share an hour, so they
+    # can be combined by addition like the sums and counts.
+    state = state.add(daily, fill_value=0)
+
+    return state.astype({'Total': 'float64', 'Hours': 'int64',
+                         'Mask': 'int64'})
+
+
+def stream_hourly_csv(path, state=None, chunksize=100000):
+    """
+    Folds an hourly csv file into the running daily aggregates, reading
+    it in chunks so the file never has to fit in memory.
+
+    Args:
+        path (str): csv with columns Location_I, Datetime and PM2.5.
+        state (pandas dataframe): running aggregates to add to, by
+            default empty.
+        chunksize (int): number of rows read at a time.
+
+    Returns:
+        state (pandas dataframe): the updated aggregates.
+    """
+
+    if state is None:
+        state = empty_state()
+
+    columns = ['Location_I', 'Datetime', 'PM2.5']
+    # TextFileReader is only a context manager from pandas 1.2.
+    reader = pd.read_csv(path, usecols=columns, chunksize=chunksize)
+    try:
+        for chunk in reader:
+            state = ingest_hourly(state, chunk)
+    finally:
+        reader.close()
+
+    return state
+
+
+def daily_averages(state, stations):
+    """
+    Returns the daily average of every station on every day between the
+    first and last day aggregated, in the schema of
+    Daily_Avg_PM2.5_Location.csv. Days without all 24 hours have a
+    missing average and category.
+
+    Args:
+        state (pandas dataframe): running daily aggregates.
+        stations (pandas dataframe): columns Location_I, Name, Latitude
+            and Longitude of each station.
+
+    Returns:
+        daily (pandas dataframe): columns Date, Avg_PM2.5, Location_I,
+            Name, Latitude, Longitude and Category, sorted by station
+            and date.
+    """
+
+    stations = stations.drop_duplicates('Location_I')
+    stations = stations.sort_values('Location_I').set_index('Location_I')
+
+    days = state.index.get_level_values('Date')
+    if len(days) == 0:
+        dates = pd.DatetimeIndex([])
+    else:
+        dates = pd.date_range(days.min(), days.max(), freq='D')
+    grid = pd.MultiIndex.from_product(
+        [stations.index.astype('int64'), dates], names=state.index.names)
+    full = state.reindex(grid)
+
+    complete = full['Hours'].to_numpy() == HOURS_PER_DAY
+    with np.errstate(invalid='ignore'):
+        average = full['Total'].to_numpy() / full['Hours'].to_numpy()
+    average = np.where(complete, average, np.nan)
+
+    location = grid.get_level_values('Location_I')
+    site = stations.loc[location]
+    daily = pd.DataFrame({
+        'Date': grid.get_level_values('Date'),
+        'Avg_PM2.5': average,
+        'Location_I': location,
+        'Name': site['Name'].to_numpy(),
+        'Latitude': site['Latitude'].to_numpy(),
+        'Longitude': site['Longitude'].to_numpy(),
+        'Category': aqi_category(average),
+    })
+
+    return daily[DAILY_COLUMNS]
+
+
+def save_state(state, path):
+    """
+    Stores the running daily aggregates as a column store.
+
+    Args:
+        state (pandas dataframe): running daily aggregates.
+        path (str): directory to store them in.
+    """
+
+    column_store.write_store(state.reset_index(), path, STATE_SCHEMA)
+
+
+def load_state(path):
+    """
+    Loads running daily aggregates stored with save_state.
+
+    Args:
+        path (str): directory the aggregates are stored in.
+
+    Returns:
+        state (pandas dataframe): the running aggregates, or empty ones
+            if nothing is stored at the path yet.
+    """
+
+    if not os.path.isdir(path):
+        return empty_state()
+
+    data = column_store.load_store(path, mmap=False)
+    return data.set_index(['Location_I', 'Date'])
@@ -0,0 +1,377 @@
+"""
+Two-tier memoization for the app callbacks: a small in-process LRU tier
+in front of an on-disk tier shared by every worker process.
+
+Results are found in the LRU tier without any I/O, then in the disk
+tier, and only computed when neither holds them. Keys are canonical,
+so the same selection made in a different order (e.g. a species list)
+hits the same entry, and they include a version, so entries computed
+from older data are never served. Each function keeps the results of
+one version on disk: those of other versions are removed, and the
+least recently used results beyond a cap are evicted. Requests can
+also be counted in a log in the cache directory, so that a warm-up job
+can precompute the most requested arguments; counts are batched in
+memory and the log is compacted as it grows.
+
+Functions:
+
+canonical_key(value)
+    -- Returns an order-insensitive, hashable form of an argument.
+
+tiered_memoize(cache_dir=None, maxsize=256, version='', log_requests=False,
+               max_disk_entries=10000)
+    -- Decorator memoizing a function in the two tiers.
+
+popular_requests(cache_dir, function, top=None)
+    -- Counts the logged requests of a memoized function.
+
+file_version(paths)
+    -- Returns a version string that changes whenever a file does.
+"""
+
+import atexit
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from phoenix.code.file_io import atomic_file, file_lock
+
+
+REQUEST_LOG = 'requests.log'
+
+# Requests counted in memory before they are appended to the log.
+LOG_BATCH = 100
+
+# Size in bytes of the request log above which it is compacted.
+LOG_COMPACT_BYTES = 1 << 20
+
+# Results saved to the disk tier between checks of its size.
+PRUNE_EVERY = 100
+
+# Marks a disk tier miss, as None may be a cached value.
+_MISSING = object()
+
+
+def canonical_key(value):
+    """
+    Returns a hashable form of an argument in which lists, tuples and
+    sets are sorted and deduplicated, so they are compared as sets.
+
+    Args:
+        value: argument of a memoized function.
+
+    Returns:
+        key: the canonical form of the argument.
+    """
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = {canonical_key(item) for item in value}
+        return tuple(sorted(items, key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical_key(item))
+                            for key, item in value.items()))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def tiered_memoize(cache_dir=None, maxsize=256, version='',
+                   log_requests=False, max_disk_entries=10000):
+    """
+    Memoizes a function of positional arguments in an in-process LRU
+    tier and, if cache_dir is given, an on-disk tier.
+
+    The memoized function gets a warm method, which fills both tiers
+    for some arguments without counting them as a request, and a
+    flush_requests method, which appends the requests counted in
+    memory to the request log.
+
+    Args:
+        cache_dir (str): directory of the disk tier, shared by the
+            processes using it; None keeps results in memory only.
+        maxsize (int): number of results held in the LRU tier.
+        version (str): included in the disk keys, to be changed
+            whenever the results would change, e.g. with the data.
+            Results of other versions are removed from the disk tier.
+        log_requests (bool): count the canonical arguments of every
+            call in the request log of cache_dir.
+        max_disk_entries (int): number of results kept in the disk
+            tier, the least recently used being evicted; None keeps
+            all of them.
+
+    Returns:
+        decorator (function): the memoizing decorator.
+    """
+
+    def decorator(function):
+        name = f'{function.__module__}.{function.__qualname__}'
+        memory = OrderedDict()
+        lock = threading.Lock()
+        pending = Counter()
+        tally = {'pending': 0, 'saved': 0}
+
+        result_dir = None
+        if cache_dir is not None:
+            result_dir = os.path.join(cache_dir, _result_dir(name, version))
+            _prune(cache_dir, result_dir, max_disk_entries)
+
+        def flush_requests():
+            with lock:
+                batch = dict(pending)
+                pending.clear()
+                tally['pending'] = 0
+            if batch:
+                _log_requests(cache_dir, name, batch)
+
+        def lookup(args, count_request):
+            # Arguments keep their positions; only each one's own items
+            # are compared as a set.
+            key = tuple(canonical_key(arg) for arg in args)
+
+            with lock:
+                if count_request:
+                    pending[key] += 1
+                    tally['pending'] += 1
+                    flush = tally['pending'] >= LOG_BATCH
+                else:
+                    flush = False
+                if key in memory:
+                    memory.move_to_end(key)
+                    value = memory[key]
+                else:
+                    value = _MISSING
+            if flush:
+                flush_requests()
+            if value is not _MISSING:
+                return value
+
+            if result_dir is not None:
+                path = os.path.join(result_dir, _digest(key))
+                value = _load(path)
+            if value is _MISSING:
+                value = function(*args)
+                if result_dir is not None:
+                    _save(path, value)
+                    with lock:
+                        tally['saved'] += 1
+                        prune = tally['saved'] % PRUNE_EVERY == 0
+                    if prune:
+                        _prune(cache_dir, result_dir, max_disk_entries)
+
+            with lock:
+                memory[key] = value
+                if len(memory) > maxsize:
+                    memory.popitem(last=False)
+
+            return value
+
+        counting = log_requests and cache_dir is not None
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            return lookup(args, counting)
+
+        def warm(*args):
+            return lookup(args, False)
+
+        wrapper.cache_name = name
+        wrapper.warm = warm
+        wrapper.flush_requests = flush_requests
+        if counting:
+            atexit.register(flush_requests)
+
+        return wrapper
+
+    return decorator
+
+
+def popular_requests(cache_dir, function, top=None):
+    """
+    Counts the logged requests of a memoized function, and compacts the
+    request log to one line per distinct request.
+
+    Args:
+        cache_dir (str): directory of the disk tier.
+        function (function): memoized function with log_requests.
+        top (int): number of requests to return, by default all.
+
+    Returns:
+        requests (list): (arguments, count) of the most requested
+            arguments first; arguments are lists as stored in json.
+    """
+
+    function.flush_requests()
+    path = os.path.join(cache_dir, REQUEST_LOG)
+    with file_lock(path):
+        counts = _compact_log(path)
+
+    requests = [(json.loads(key), count)
+                for (name, key), count in counts.most_common()
+                if name == function.cache_name]
+
+    return requests[:top]
+
+
+def file_version(paths):
+    """
+    Returns a version string that changes whenever one of the files is
+    modified, for keying results computed from them.
+
+    Args:
+        paths (list): files the results depend on; missing files are
+            skipped.
+
+    Returns:
+        version (str): digest of the size and modification time of
+            each file.
+    """
+
+    stamps = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps.append(f'{path}:{stat.st_size}:{stat.st_mtime_ns}')
+
+    return hashlib.sha256('\n'.join(stamps).encode()).hexdigest()[:16]
+
+
+def _result_dir(name, version):
+    """
+    Returns the directory name of the results of a function version,
+    prefixed by a digest of the function name alone.
+    """
+
+    name_digest = hashlib.sha256(name.encode()).hexdigest()[:16]
+    version_digest = hashlib.sha256(version.encode()).hexdigest()[:16]
+    return f'{name_digest}-{version_digest}'
+
+
+def _digest(key):
+    """
+    Returns the file name of a result in the disk tier.
+    """
+
+    return hashlib.sha256(repr(key).encode()).hexdigest() + '.pkl'
+
+
+def _prune(cache_dir, result_dir, max_entries):
+    """
+    Removes the results of other versions of a function from the disk
+    tier, and the least recently used of its results beyond max_entries.
+    Files removed by another process at the same time are skipped.
+    """
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    prefix = os.path.basename(result_dir).split('-')[0] + '-'
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        stale = entry.startswith(prefix) and path != result_dir
+        if stale and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    if max_entries is None or not os.path.isdir(result_dir):
+        return
+
+    stamps = []
+    for entry in os.listdir(result_dir):
+        try:
+            stamps.append((os.path.getmtime(os.path.join(result_dir, entry)),
+                           entry))
+        except OSError:
+            continue
+    stamps.sort()
+
+    for _, entry in stamps[:max(len(stamps) - max_entries, 0)]:
+        try:
+            os.remove(os.path.join(result_dir, entry))
+        except OSError:
+            continue
+
+
+def _load(path):
+    """
+    Reads a result from the disk tier, marking it as recently used, or
+    returns _MISSING.
+    """
+
+    try:
+        with open(path, 'rb') as result_file:
+            value = pickle.load(result_file)
+        os.utime(path)
+        return value
+    except Exception:
+        # Also covers results pickled by older code, whose classes may
+        # have moved or gone; they are recomputed.
+        return _MISSING
+
+
+def _save(path, value):
+    """
+    Writes a result to the disk tier. A result that cannot be written,
+    e.g. on a full disk, is only kept in memory and recomputed later.
+    """
+
+    try:
+        with atomic_file(path) as result_file:
+            pickle.dump(value, result_file, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+
+def _log_requests(cache_dir, name, batch):
+    """
+    Appends a batch of request counts to the request log, one line per
+    distinct request, and compacts the log once it grows too large.
+    The log is shared by several processes, so it is only written
+    under its file lock.
+    """
+
+    path = os.path.join(cache_dir, REQUEST_LOG)
+    lines = ''.join(json.dumps([name, key, count]) + '\n'
+                    for key, count in batch.items())
+    with file_lock(path):
+        with open(path, 'a') as log_file:
+            log_file.write(lines)
+
+        if os.path.getsize(path) > LOG_COMPACT_BYTES:
+            _compact_log(path)
+
+
+def _compact_log(path):
+    """
+    Sums the counts of the request log by function and request, and
+    rewrites it with one line per distinct request. The caller holds
+    the file lock of the log, so no line is appended in between.
+
+    Returns:
+        counts (Counter): count by (function name, json request).
+    """
+
+    counts = Counter()
+    if not os.path.exists(path):
+        return counts
+
+    with open(path) as log_file:
+        for line in log_file:
+            try:
+                name, key, count = json.loads(line)
+            except ValueError:
+                # Skips a line cut short by a process that crashed.
+                continue
+            counts[(name, json.dumps(key))] += count
+
+    lines = [json.dumps([name, json.loads(key), count])
+             for (name, key), count in counts.items()]
+    with atomic_file(path, 'w') as log_file:
+        log_file.write(''.join(line + '\n' for line in lines))
+
+    return counts
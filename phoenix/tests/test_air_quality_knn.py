@@ -3,11 +3,16 @@ Unittests for the k-nearest-neighbors function (air_quality_knn.py)
 and associated verify_location function that jointly work
 to output air quality estimates for each bird observation.
 """
+import os
+import tempfile
 import unittest
+import warnings
+from unittest import mock
 import pandas as pd
 import numpy as np
 
 from phoenix.code import air_quality_knn as knn
+from phoenix.code import county_geometry
 
 
 class Testairqualityknn(unittest.TestCase):
@@ -80,7 +85,9 @@ class Testairqualityknn(unittest.TestCase):
         bad_location_birds.at[0, 'latitude'] = 30
 
         with self.assertWarns(Warning):
-            knn.verify_location(bad_location_birds)
+            outside = knn.verify_location(bad_location_birds)
+
+        self.assertTrue(np.array_equal(outside, [0]))
 
     def test_invalid_input_order(self):
         """
@@ -195,6 +202,331 @@ class Testairqualityknn(unittest.TestCase):
 
         self.assertTrue(all(knn_diffs.le(0.25 * birds_knn)))
 
+    def test_knn_row_order(self):
+        """
+        Tests that the predictions are attached to the correct bird
+        observations no matter how the input rows are ordered, and that
+        observations on days without air quality data are left as NaN.
+
+        Asserts: True if shuffling the bird observations gives the same
+            prediction for each observation, and the unmatched day is NaN.
+        """
+
+        birds = self.bird_data_example.copy()
+        birds.at[9, 'observation date'] = '2020-12-25'
+        shuffled = birds.sample(frac=1, random_state=0)
+
+        in_order = knn.air_quality_knn(self.air_data.copy(), birds)
+        out_of_order = knn.air_quality_knn(self.air_data.copy(), shuffled)
+
+        self.assertTrue(np.isnan(in_order.at[9, 'Avg_PM2.5']))
+        self.assertTrue(in_order['Avg_PM2.5'].equals(
+            out_of_order['Avg_PM2.5'].sort_index()))
+
+    def test_knn_haversine(self):
+        """
+        Checks the haversine metric against a manual great-circle knn
+        for each bird observation.
+
+        Asserts: True if the haversine knn output matches the mean of the
+            5 stations with the smallest great-circle distance.
+        """
+
+        birds = knn.air_quality_knn(self.air_data.copy(),
+                                    self.bird_data_example.copy(),
+                                    metric='haversine')
+
+        for ind in birds.index:
+            day = birds.at[ind, 'observation date']
+            aq_day = self.air_data[pd.to_datetime(self.air_data['Date']) == day]
+            aq_day = aq_day[aq_day['Avg_PM2.5'].notna()]
+
+            lat1, lon1 = np.radians(aq_day[['Latitude', 'Longitude']].values).T
+            lat2, lon2 = np.radians(birds.loc[ind, ['latitude', 'longitude']].values.astype(float))
+            dlat = np.sin((lat1 - lat2) / 2) ** 2
+            dlon = np.cos(lat1) * np.cos(lat2) * np.sin((lon1 - lon2) / 2) ** 2
+            hav = dlat + dlon
+            nearest = np.argsort(hav)[:5]
+            expected = aq_day['Avg_PM2.5'].values[nearest].mean()
+
+            self.assertAlmostEqual(birds.at[ind, 'Avg_PM2.5'], expected)
+
+    def test_invalid_metric(self):
+        """
+        Tests that the knn function rejects an unsupported metric.
+
+        Asserts: Raises ValueError if the metric is not recognized.
+        """
+
+        with self.assertRaises(ValueError):
+            knn.air_quality_knn(self.air_data, self.bird_data_example,
+                                metric='manhattan')
+
+    def test_shared_station_set(self):
+        """
+        Tests that days reporting the same stations (listed in a different
+        order) share neighbors but are re-weighted with their own values.
+
+        Asserts: True if doubling every station value on the second day
+            doubles the estimate at the same bird location.
+        """
+
+        lats = [44.0, 44.5, 45.0, 45.5, 43.5, 43.0]
+        lons = [-123.0, -122.0, -121.0, -120.0, -119.0, -118.0]
+        values = [1.0, 2.0, 3.0, 4.0, 5.0, 60.0]
+        air_data = pd.DataFrame({
+            'Date': ['2020-08-01'] * 6 + ['2020-08-02'] * 6,
+            'Latitude': lats + lats[::-1],
+            'Longitude': lons + lons[::-1],
+            'Avg_PM2.5': values + [2 * v for v in values[::-1]]})
+
+        birds = self.bird_data_example.iloc[:2].copy()
+        birds['latitude'] = 44.2
+        birds['longitude'] = -121.5
+        birds['observation date'] = ['2020-08-01', '2020-08-02']
+
+        birds = knn.air_quality_knn(air_data, birds)
+
+        self.assertAlmostEqual(birds.at[0, 'Avg_PM2.5'], 3.0)
+        self.assertAlmostEqual(birds.at[1, 'Avg_PM2.5'], 6.0)
+
+    def test_knn_parallel(self):
+        """
+        Tests that splitting the days across worker processes gives the
+        same output as running them serially, with a single warning for
+        all days with too few stations.
+
+        Asserts: True if the parallel and serial outputs are equal and
+            exactly one warning is raised.
+        """
+
+        too_short_air_quality = self.air_data.iloc[::2, :]
+
+        serial = knn.air_quality_knn(too_short_air_quality.copy(),
+                                     self.bird_data_example.copy())
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            parallel = knn.air_quality_knn(too_short_air_quality.copy(),
+                                           self.bird_data_example.copy(),
+                                           n_jobs=2)
+
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(serial['Avg_PM2.5'].equals(parallel['Avg_PM2.5']))
+
+    def test_knn_csv_chunks(self):
+        """
+        Tests that streaming the eBird data from a csv in small chunks
+        gives the same estimates as enriching the whole dataframe.
+
+        Asserts: True if every row is written and the streamed estimates
+            match the in-memory ones.
+        """
+
+        in_memory = knn.air_quality_knn(self.air_data.copy(),
+                                        self.bird_data_example.copy())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ebd_path = os.path.join(tmp, 'ebird.csv')
+            output_path = os.path.join(tmp, 'ebird_aq.csv')
+            self.bird_data_example.to_csv(ebd_path, index=False)
+
+            rows = knn.air_quality_knn_csv(self.air_data, ebd_path,
+                                           output_path, chunksize=3)
+            streamed = pd.read_csv(output_path)
+
+        self.assertEqual(rows, len(self.bird_data_example))
+        self.assertTrue(np.allclose(streamed['Avg_PM2.5'],
+                                    in_memory['Avg_PM2.5'], equal_nan=True))
+
+    def test_verify_location_counties(self):
+        """
+        Tests that verify_location can check the coordinates exactly
+        against county polygons as well as the rough range of Oregon.
+
+        Asserts: Warns with the index of a point inside the rough range
+            of Oregon but outside every county polygon.
+        """
+
+        square = [[[-125, 40], [-115, 40], [-115, 44.5], [-125, 44.5], [-125, 40]]]
+        geojson = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'altname': 'South'},
+             'geometry': {'type': 'Polygon', 'coordinates': square}}]}
+        county_index = county_geometry.build_county_index(geojson)
+
+        locations = self.bird_data_example[['latitude', 'longitude']]
+
+        with self.assertWarns(Warning):
+            outside = knn.verify_location(locations, county_index)
+
+        self.assertTrue(np.array_equal(outside, [0, 1, 3, 4, 6, 7, 8, 9]))
+
+    def test_knn_cache(self):
+        """
+        Tests that stored daily results are reused on a re-run, and that
+        only a day whose bird locations changed is computed again.
+
+        Asserts: True if the cached run gives the same output, fits no
+            station index, and a changed day refits exactly one.
+        """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first = knn.air_quality_knn(self.air_data.copy(),
+                                        self.bird_data_example.copy(),
+                                        cache_dir=tmp)
+
+            with mock.patch.object(knn, '_fit_station_index',
+                                   wraps=knn._fit_station_index) as fit:
+                second = knn.air_quality_knn(self.air_data.copy(),
+                                             self.bird_data_example.copy(),
+                                             cache_dir=tmp)
+                self.assertEqual(fit.call_count, 0)
+
+                changed = self.bird_data_example.copy()
+                changed.at[0, 'latitude'] = 44.5
+                knn.air_quality_knn(self.air_data.copy(), changed,
+                                    cache_dir=tmp)
+                self.assertEqual(fit.call_count, 1)
+
+        self.assertTrue(first['Avg_PM2.5'].equals(second['Avg_PM2.5']))
+
+    def test_weight_matrix(self):
+        """
+        Tests that the sparse weight matrix reproduces the knn estimates
+        for both uniform and inverse-distance weights, and re-scores new
+        PM2.5 values without refitting.
+
+        Asserts: True if the matrix product matches air_quality_knn, and
+            doubling the PM2.5 readings doubles every estimate.
+        """
+
+        for weights in ['uniform', 'distance']:
+            expected = knn.air_quality_knn(self.air_data.copy(),
+                                           self.bird_data_example.copy(),
+                                           weights=weights)
+
+            weight_matrix = knn.knn_weight_matrix(self.air_data,
+                                                  self.bird_data_example,
+                                                  weights=weights)
+            pm25 = self.air_data['Avg_PM2.5'].values
+            estimates = knn.apply_knn_weights(weight_matrix, pm25)
+
+            self.assertEqual(weight_matrix.shape,
+                             (len(self.bird_data_example), len(self.air_data)))
+            self.assertTrue(np.allclose(estimates, expected['Avg_PM2.5'],
+                                        equal_nan=True))
+            self.assertTrue(np.allclose(knn.apply_knn_weights(weight_matrix, 2 * pm25),
+                                        2 * estimates, equal_nan=True))
+
+    def test_weight_matrix_missing_reading(self):
+        """
+        Tests that a missing reading is not counted as zero when the
+        weight matrix re-scores PM2.5 values.
+
+        Asserts: True if the estimates using a missing reading are NaN
+            and the other estimates are unchanged.
+        """
+
+        weight_matrix = knn.knn_weight_matrix(self.air_data,
+                                              self.bird_data_example).tocsr()
+        pm25 = self.air_data['Avg_PM2.5'].values.astype(float)
+        estimates = knn.apply_knn_weights(weight_matrix, pm25)
+
+        row = np.flatnonzero(np.diff(weight_matrix.indptr))[0]
+        missing = weight_matrix.indices[weight_matrix.indptr[row]]
+        pm25[missing] = np.nan
+        rescored = knn.apply_knn_weights(weight_matrix, pm25)
+
+        uses_missing = weight_matrix[:, missing].toarray().ravel() != 0
+        self.assertTrue(np.isnan(rescored[row]))
+        self.assertTrue(np.isnan(rescored[uses_missing]).all())
+        self.assertTrue(np.allclose(rescored[~uses_missing],
+                                    estimates[~uses_missing], equal_nan=True))
+
+    def test_estimate_air_quality(self):
+        """
+        Tests the array version of the knn, which returns only the
+        estimates or writes them into a given buffer.
+
+        Asserts: True if the estimates match air_quality_knn, the output
+            buffer is filled in place and neither input is modified.
+        """
+
+        air_data = self.air_data.copy()
+        birds = self.bird_data_example.copy()
+
+        expected = knn.air_quality_knn(self.air_data.copy(),
+                                       self.bird_data_example.copy())
+
+        out = np.zeros(len(birds))
+        estimates = knn.estimate_air_quality(
+            air_data, birds['observation date'], birds['latitude'].values,
+            birds['longitude'].values, out=out)
+
+        self.assertIs(estimates, out)
+        self.assertTrue(np.allclose(out, expected['Avg_PM2.5'], equal_nan=True))
+        self.assertTrue(air_data.equals(self.air_data))
+        self.assertTrue(birds.equals(self.bird_data_example))
+
+    def test_knn_spatiotemporal(self):
+        """
+        Tests that the spatiotemporal metric fills days with fewer than
+        5 stations by borrowing from adjacent days, in a way that the
+        weight matrix reproduces.
+
+        Asserts: True if no warning is raised, every observation gets an
+            estimate, and the weight matrix gives the same estimates.
+        """
+
+        too_short_air_quality = self.air_data.iloc[::2, :]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            birds = knn.air_quality_knn(too_short_air_quality.copy(),
+                                        self.bird_data_example.copy(),
+                                        metric='spatiotemporal')
+
+        weight_matrix = knn.knn_weight_matrix(too_short_air_quality,
+                                              self.bird_data_example,
+                                              metric='spatiotemporal')
+        estimates = knn.apply_knn_weights(weight_matrix,
+                                          too_short_air_quality['Avg_PM2.5'])
+
+        self.assertEqual(len(caught), 0)
+        self.assertFalse(birds['Avg_PM2.5'].isna().any())
+        self.assertTrue(np.allclose(estimates, birds['Avg_PM2.5']))
+
+    def test_spatiotemporal_reported_days(self):
+        """
+        Tests that the spatiotemporal metric leaves fully reported days
+        to their own stations, and that a small time scale does not.
+
+        Asserts: True if the estimates equal those of the daily
+            haversine metric wherever that has one, and differ once a
+            day counts as only a tenth of a degree.
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            daily = knn.estimate_air_quality(
+                self.air_data, self.bird_data_example['observation date'],
+                self.bird_data_example['latitude'],
+                self.bird_data_example['longitude'], metric='haversine')
+            season = knn.estimate_air_quality(
+                self.air_data, self.bird_data_example['observation date'],
+                self.bird_data_example['latitude'],
+                self.bird_data_example['longitude'], metric='spatiotemporal')
+            blended = knn.estimate_air_quality(
+                self.air_data, self.bird_data_example['observation date'],
+                self.bird_data_example['latitude'],
+                self.bird_data_example['longitude'], metric='spatiotemporal',
+                time_scale=0.1)
+
+        reported = ~np.isnan(daily)
+        self.assertTrue(reported.any())
+        self.assertTrue(np.allclose(season[reported], daily[reported]))
+        self.assertFalse(np.allclose(blended[reported], daily[reported]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@ import unittest
 
 import phoenix.code.appfunctions as af
 
+import numpy as np
 import pandas as pd
 
 
@@ -74,6 +75,151 @@ class TestAppFunctions(unittest.TestCase):
             af.subset_date(
                 bird_data, 'observation date', month, day)
 
+    def test_date_index_subset_date(self):
+        """
+        Test for subset_date with an index from build_date_index.
+        Returns true if the indexed subset equals the scanned subset,
+        and a date without rows raises a Value Error.
+        """
+        data = {'observation date': ['08-02-2020', '08-01-2020',
+                                     '09-01-2020', '08-01-2020'],
+                'species': ['American Crow', 'Steller\'s Jay',
+                            'American Crow', 'American Crow']}
+        bird_data = pd.DataFrame(data, columns=['observation date', 'species'])
+        bird_data['observation date'] = pd.to_datetime(bird_data['observation date'])
+        sorted_data, date_index = af.build_date_index(
+            bird_data, 'observation date')
+
+        data_test = af.subset_date(sorted_data, 'observation date',
+                                   'August', 1, date_index)
+        data_result = af.subset_date(bird_data, 'observation date',
+                                     'August', 1)
+
+        self.assertTrue(data_test.equals(data_result))
+        with self.assertRaises(ValueError):
+            af.subset_date(sorted_data, 'observation date', 'August', 5,
+                           date_index)
+
+    def test_query_rows(self):
+        """
+        Test for query_rows.
+        Returns true if indexed queries on several columns and a date
+        match boolean filtering of the dataframe.
+        """
+        rng = np.random.default_rng(0)
+        bird_data = pd.DataFrame({
+            'observation date': pd.to_datetime('2020-08-01') + pd.to_timedelta(
+                rng.integers(0, 40, 500), unit='D'),
+            'common name': rng.choice(['American Crow', 'Common Raven',
+                                       'Steller\'s Jay'], 500),
+            'county': rng.choice(['Lane', 'Linn', 'Benton'], 500)})
+        bird_data, date_index = af.build_date_index(bird_data, 'observation date')
+        query_index = af.build_query_index(
+            bird_data, ['common name', 'county'], date_index)
+
+        species = ['American Crow', 'Common Raven']
+        data_test = af.query_rows(bird_data, query_index,
+                                  {'common name': species, 'county': 'Lane'},
+                                  'August', 3)
+        dates = bird_data['observation date']
+        on_date = (dates.dt.month == 8) & (dates.dt.day == 3)
+        in_lane = bird_data['county'] == 'Lane'
+        data_result = bird_data.loc[
+            bird_data['common name'].isin(species) & in_lane & on_date]
+
+        self.assertFalse(data_test.empty)
+        self.assertTrue(data_test.equals(data_result))
+        self.assertTrue(af.query_rows(bird_data, query_index,
+                                      {'county': ['Lane', 'Linn']}).equals(
+            bird_data.loc[bird_data['county'].isin(['Lane', 'Linn'])]))
+        self.assertTrue(af.query_rows(bird_data, query_index,
+                                      {'county': 'Polk'}).empty)
+
+    def test_shared_query_index(self):
+        """
+        Test for query_orders and build_date_index on stored data.
+        Returns true if an index built from stored row orders equals a
+        fresh one, and already sorted data is indexed without a copy.
+        """
+        rng = np.random.default_rng(1)
+        bird_data = pd.DataFrame({
+            'observation date': pd.to_datetime('2020-08-01') + pd.to_timedelta(
+                rng.integers(0, 40, 200), unit='D'),
+            'county': rng.choice(['Lane', 'Linn', 'Benton'], 200)})
+        bird_data, date_index = af.build_date_index(bird_data, 'observation date')
+        orders = af.query_orders(bird_data, ['county'])
+
+        resorted, _ = af.build_date_index(bird_data, 'observation date')
+        shared = af.build_query_index(resorted, ['county'], orders=orders)
+        fresh = af.build_query_index(bird_data, ['county'])
+
+        self.assertIs(resorted, bird_data)
+        for county, positions in fresh['columns']['county'].items():
+            np.testing.assert_array_equal(
+                shared['columns']['county'][county], positions)
+
+    def test_county_counts(self):
+        """
+        Test for build_count_cube and county_counts.
+        Returns true if counts read from the cube match grouping the
+        observations of the selected counties.
+        """
+        rng = np.random.default_rng(1)
+        bird_data = pd.DataFrame({
+            'observation date': pd.to_datetime('2020-08-01') + pd.to_timedelta(
+                rng.integers(0, 10, 300), unit='D'),
+            'family': rng.choice(['Corvidae', 'Picidae'], 300),
+            'county': rng.choice(['Lane', 'Linn', 'Benton'], 300),
+            'observation count': rng.integers(1, 20, 300)})
+        count_cube = af.build_count_cube(bird_data, ['family'])
+
+        for county_name in (['Linn'], ['Lane', 'Benton'], ['Polk']):
+            sub_bird = bird_data.loc[bird_data['county'].isin(county_name)]
+            data_result = sub_bird.groupby(['family', 'observation date'])[
+                'observation count'].sum().reset_index()
+            data_test = af.county_counts(count_cube, 'family', county_name)
+            self.assertTrue(data_test.equals(data_result))
+
+        self.assertEqual(count_cube['family']['order'], ['Corvidae', 'Picidae'])
+
+    def test_county_day_values(self):
+        """
+        Test for county_day_values.
+        Returns true if the PM2.5 of a date is listed in map order, with
+        None for counties and dates without values.
+        """
+        data = {'Date': ['09-12-2020', '09-12-2020', '09-13-2020'],
+                'County': ['Lane', 'Baker', 'Lane'],
+                'Avg_PM2.5': [250.0, 12.5, 100.0]}
+        aq_data = pd.DataFrame(data, columns=['Date', 'County', 'Avg_PM2.5'])
+        aq_data['Date'] = pd.to_datetime(aq_data['Date'])
+        aq_data, date_index = af.build_date_index(aq_data, 'Date')
+        county_order = ['Baker', 'Benton', 'Lane']
+
+        self.assertEqual(af.county_day_values(aq_data, date_index, county_order,
+                                              'September', 12),
+                         [12.5, None, 250.0])
+        self.assertEqual(af.county_day_values(aq_data, date_index, county_order,
+                                              'June', 1),
+                         [None, None, None])
+
+    def test_season_values(self):
+        """
+        Test for season_values.
+        Returns true if the values of every date of the selected months
+        are keyed by month name and day.
+        """
+        data = {'Date': ['09-12-2020', '05-12-2020', '08-01-2020'],
+                'County': ['Lane', 'Lane', 'Baker'],
+                'Avg_PM2.5': [250.0, 3.0, 12.5]}
+        aq_data = pd.DataFrame(data, columns=['Date', 'County', 'Avg_PM2.5'])
+        aq_data['Date'] = pd.to_datetime(aq_data['Date'])
+        aq_data, date_index = af.build_date_index(aq_data, 'Date')
+
+        self.assertEqual(af.season_values(aq_data, date_index, ['Baker', 'Lane']),
+                         {'August 1': [12.5, None],
+                          'September 12': [None, 250.0]})
+
     def test_smoke_subset_air_quality(self):
         """
         Smoke test for subset_air_quality function.
@@ -116,6 +262,29 @@ class TestAppFunctions(unittest.TestCase):
         self.assertTrue(result_vh_dates == vh_dates)
         self.assertTrue(result_vh_dates_offset == vh_dates_offset)
 
+    def test_severe_aq_intervals(self):
+        """
+        Test for severe_aq_intervals and county_intervals.
+        Returns true if consecutive severe days of a county and category
+        are merged into one interval.
+        """
+        data = {'Date': ['09-12-2020', '09-11-2020', '09-13-2020',
+                         '09-20-2020', '09-12-2020', '09-14-2020'],
+                'AQI_Category': ['Hazardous', 'Hazardous', 'Very Unhealthy',
+                                 'Hazardous', 'Hazardous', 'Good'],
+                'County': ['Baker', 'Baker', 'Baker', 'Baker', 'Clackamas',
+                           'Baker']}
+        aq_data = pd.DataFrame(data, columns=['Date', 'AQI_Category', 'County'])
+        aq_data['Date'] = pd.to_datetime(aq_data['Date'])
+        intervals = af.severe_aq_intervals(aq_data)
+
+        self.assertEqual(intervals['Baker'],
+                         (['2020-09-11', '2020-09-20'],
+                          ['2020-09-13', '2020-09-21'],
+                          ['2020-09-13'], ['2020-09-14']))
+        self.assertEqual(af.county_intervals(intervals, ['Clackamas', 'Lane']),
+                         (['2020-09-12'], ['2020-09-13'], [], []))
+
     def test_edge_subset_air_quality(self):
         """
         Edge test for subset_air_quality function.
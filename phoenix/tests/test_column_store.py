@@ -0,0 +1,148 @@
+"""
+Unittests for the typed column store of the phoenix datasets.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import phoenix.code.column_store as cs
+
+
+class TestColumnStore(unittest.TestCase):
+    """
+    Contains test cases for column_store.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp.name, 'county_aq.csv')
+        data = pd.DataFrame({'Date': ['2020-09-01', '2020-09-02'],
+                             'County': ['Lane', 'Baker'],
+                             'Avg_PM2.5': [300.1, np.nan],
+                             'AQI_Category': ['Hazardous', np.nan]})
+        data.to_csv(self.csv_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_convert_csv(self):
+        """
+        Test for convert_csv.
+        Returns true if the stored columns have the schema dtypes and
+        the csv values.
+        """
+        store_path = os.path.join(self.tmp.name, 'county_aq.store')
+        data = cs.convert_csv(self.csv_path, store_path,
+                              cs.SCHEMAS['county_aq'])
+
+        self.assertEqual(list(data.columns), list(cs.SCHEMAS['county_aq']))
+        self.assertEqual(data['Date'].dtype, np.dtype('datetime64[ns]'))
+        self.assertEqual(data['County'].dtype, 'category')
+        self.assertEqual(list(data['County']), ['Lane', 'Baker'])
+        self.assertEqual(data['Avg_PM2.5'][0], 300.1)
+        self.assertTrue(pd.isna(data['AQI_Category'][1]))
+
+    def test_load_store_columns(self):
+        """
+        Test for load_store.
+        Returns true if only the requested columns are loaded, backed by
+        memory-mapped files.
+        """
+        store_path = os.path.join(self.tmp.name, 'county_aq.store')
+        cs.convert_csv(self.csv_path, store_path, cs.SCHEMAS['county_aq'])
+        data = cs.load_store(store_path, columns=['Avg_PM2.5', 'Date'])
+
+        self.assertEqual(list(data.columns), ['Avg_PM2.5', 'Date'])
+        self.assertIsInstance(data['Avg_PM2.5'].to_numpy().base, np.memmap)
+
+    def test_load_store_shared(self):
+        """
+        Test for load_store with columns of the same dtype.
+        Returns true if every column, codes of categoricals included,
+        is still read from the mapped files after rows are selected,
+        i.e. no column was consolidated into a private copy.
+        """
+        store_path = os.path.join(self.tmp.name, 'ebird.store')
+        data = pd.DataFrame({'observation date': ['2020-09-01', '2020-09-02'],
+                             'common name': ['Crow', 'Raven'],
+                             'family': ['Corvidae', 'Corvidae'],
+                             'order': ['Passeriformes', 'Passeriformes'],
+                             'county': ['Lane', 'Baker'],
+                             'observation count': [1, 2],
+                             'latitude': [44.0, 45.0],
+                             'longitude': [-123.0, -117.8]})
+        cs.write_store(data, store_path, cs.SCHEMAS['ebird'])
+
+        data = cs.load_store(store_path)
+        data.iloc[[1, 0]]
+
+        for name in data.columns:
+            values = data[name].array
+            values = getattr(values, 'codes', data[name].to_numpy())
+            while not isinstance(values, np.memmap):
+                self.assertIsNotNone(values.base, name)
+                values = values.base
+
+    def test_read_table_stale(self):
+        """
+        Test for read_table.
+        Returns true if the store is rebuilt after the csv changes.
+        """
+        schema = cs.SCHEMAS['county_aq']
+        self.assertEqual(len(cs.read_table(self.csv_path, schema)), 2)
+
+        pd.DataFrame({'Date': ['2020-09-03'], 'County': ['Lane'],
+                      'Avg_PM2.5': [4.0], 'AQI_Category': ['Good']}
+                     ).to_csv(self.csv_path)
+        stamp = os.path.getmtime(self.csv_path) + 10
+        os.utime(self.csv_path, (stamp, stamp))
+
+        data = cs.read_table(self.csv_path, schema, columns=['County'])
+        self.assertEqual(list(data['County']), ['Lane'])
+
+    def test_write_store_failed_cast(self):
+        """
+        Test for write_store.
+        Returns true if a failed cast leaves the old store in place and
+        no staging directory behind.
+        """
+        store_path = os.path.join(self.tmp.name, 'county_aq.store')
+        schema = cs.SCHEMAS['county_aq']
+        cs.convert_csv(self.csv_path, store_path, schema)
+
+        bad = pd.read_csv(self.csv_path).assign(**{'Avg_PM2.5': 'high'})
+        with self.assertRaises(ValueError):
+            cs.write_store(bad, store_path, schema)
+
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ['county_aq.csv', 'county_aq.store'])
+        self.assertEqual(len(cs.load_store(store_path)), 2)
+
+    def test_build_shared_store(self):
+        """
+        Test for build_shared_store.
+        Returns true if the store is only built again for a new version.
+        """
+        store_path = os.path.join(self.tmp.name, 'shared', 'county_aq.store')
+        schema = cs.SCHEMAS['county_aq']
+        builds = []
+
+        def build():
+            builds.append(1)
+            return pd.read_csv(self.csv_path)
+
+        cs.build_shared_store(store_path, schema, build, version='1')
+        cs.build_shared_store(store_path, schema, build, version='1')
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(len(cs.load_store(store_path)), 2)
+
+        cs.build_shared_store(store_path, schema, build, version='2')
+        self.assertEqual(len(builds), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Unittests for the grid-indexed point-in-polygon lookups against the
+county geometry (county_geometry.py).
+"""
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from phoenix.code import county_geometry as cg
+
+
+class TestCountyGeometry(unittest.TestCase):
+    """
+    Contains test cases for county_geometry
+    """
+
+    def setUp(self):
+
+        # Two neighboring square counties, the second with a hole
+        west = [[[-124, 43], [-122, 43], [-122, 45], [-124, 45], [-124, 43]]]
+        east = [[[[-122, 43], [-120, 43], [-120, 45], [-122, 45], [-122, 43]],
+                 [[-121.5, 43.5], [-120.5, 43.5], [-120.5, 44.5],
+                  [-121.5, 44.5], [-121.5, 43.5]]]]
+
+        self.geojson = {
+            'type': 'FeatureCollection',
+            'features': [
+                {'type': 'Feature', 'properties': {'altname': 'West'},
+                 'geometry': {'type': 'Polygon', 'coordinates': west}},
+                {'type': 'Feature', 'properties': {'altname': 'East'},
+                 'geometry': {'type': 'MultiPolygon', 'coordinates': east}}
+            ]
+        }
+        self.county_index = cg.build_county_index(self.geojson, cell_size=0.3)
+
+    def test_one_shot_locate_points(self):
+        """
+        One shot test for locate_points.
+
+        Asserts: True if points in each county, in the hole and off the
+            grid are assigned to the right county or to none.
+        """
+
+        latitude = [44.0, 43.2, 44.0, 44.0, 30.0]
+        longitude = [-123.0, -121.9, -121.0, -119.0, -123.0]
+
+        positions = cg.locate_points(self.county_index, latitude, longitude)
+
+        self.assertEqual(self.county_index['names'], ['West', 'East'])
+        self.assertTrue(np.array_equal(positions, [0, 1, -1, -1, -1]))
+
+    def test_assign_counties(self):
+        """
+        Test for assign_counties.
+
+        Asserts: True if points are assigned the name of their county,
+            or None outside every county.
+        """
+
+        counties = cg.assign_counties(self.county_index, [44.0, 44.0, 44.0],
+                                      [-123.0, -121.0, -120.2])
+
+        self.assertEqual(list(counties), ['West', None, 'East'])
+
+    def test_grid_matches_exact(self):
+        """
+        Tests that the grid shortcut agrees with testing every point
+        exactly against every county.
+
+        Asserts: True if both methods locate random points identically.
+        """
+
+        rng = np.random.default_rng(0)
+        latitude = rng.uniform(42.5, 45.5, 5000)
+        longitude = rng.uniform(-124.5, -119.5, 5000)
+
+        exact = np.full(5000, -1)
+        for position, edges in enumerate(self.county_index['edges']):
+            inside = cg._in_polygon(edges, longitude, latitude)
+            exact[inside] = position
+
+        positions = cg.locate_points(self.county_index, latitude, longitude)
+
+        self.assertTrue(np.array_equal(positions, exact))
+
+    def test_simplify_shared_border(self):
+        """
+        Test for simplify_geojson.
+
+        Asserts: True if a jagged border shared by two counties is
+            simplified identically for both, leaving no gap or overlap.
+        """
+
+        rng = np.random.default_rng(0)
+        lat = np.linspace(43, 45, 200)
+        lon = -122 + rng.normal(0, 0.02, 200) * np.sin(np.linspace(0, np.pi, 200))
+        border = np.c_[lon, lat].tolist()
+        west = [[-124, 43]] + border + [[-124, 45], [-124, 43]]
+        east = [[-120, 43], [-120, 45]] + border[::-1] + [[-120, 43]]
+        for feature, ring in zip(self.geojson['features'], (west, east)):
+            feature['geometry'] = {'type': 'Polygon', 'coordinates': [ring]}
+
+        simplified = cg.simplify_geojson(self.geojson, 0.01)
+        county_index = cg.build_county_index(simplified, cell_size=0.3)
+
+        latitude = rng.uniform(43.01, 44.99, 5000)
+        longitude = rng.uniform(-123.9, -120.1, 5000)
+        containing = np.zeros(5000, dtype=int)
+        for edges in county_index['edges']:
+            containing += cg._in_polygon(edges, longitude, latitude)
+
+        west_ring = simplified['features'][0]['geometry']['coordinates'][0][0]
+        self.assertLess(len(west_ring), len(west) / 2)
+        self.assertTrue(np.all(containing == 1))
+
+    def test_load_county_map(self):
+        """
+        Test for build_simplified and load_county_map.
+
+        Asserts: True if the coarsest level below half a pixel is read,
+            and the full geometry when no level is fine enough.
+        """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'counties.geojson')
+            with open(path, 'w') as geojson_file:
+                json.dump(self.geojson, geojson_file)
+
+            paths = cg.build_simplified(path, tolerances=[0.01, 0.001])
+            self.assertEqual([os.path.basename(level) for level in paths],
+                             ['counties_0.01.geojson',
+                              'counties_0.001.geojson'])
+
+            # Half a pixel is about 0.011 degrees at zoom 5 and about
+            # 0.0003 degrees at zoom 10.
+            zoom5 = cg.load_county_map(5, path, tolerances=[0.01, 0.001])
+            zoom10 = cg.load_county_map(10, path, tolerances=[0.01, 0.001])
+
+        self.assertEqual(zoom5['features'][0]['geometry']['type'],
+                         'MultiPolygon')
+        self.assertEqual(zoom10, self.geojson)
+
+    def test_fetch_county_geojson(self):
+        """
+        Test for fetch_county_geojson.
+
+        Asserts: True if the file and its levels are written once, and
+            an existing copy is not downloaded again.
+        """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source.geojson')
+            with open(source, 'w') as geojson_file:
+                json.dump(self.geojson, geojson_file)
+            url = 'file://' + os.path.abspath(source)
+            path = os.path.join(tmp, 'counties.geojson')
+
+            cg.fetch_county_geojson(url, path, tolerances=[0.01])
+            os.remove(source)
+            cg.fetch_county_geojson(url, path, tolerances=[0.01])
+
+            self.assertEqual(cg.load_county_geojson(path), self.geojson)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ['counties.geojson', 'counties.geojson.lock',
+                              'counties_0.01.geojson'])
+
+    def test_unsupported_geometry(self):
+        """
+        Edge test for build_county_index.
+
+        Asserts: Raises ValueError for a feature that is not a polygon.
+        """
+
+        self.geojson['features'][0]['geometry'] = {
+            'type': 'Point', 'coordinates': [-123, 44]}
+
+        with self.assertRaises(ValueError):
+            cg.build_county_index(self.geojson)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,15 @@ Unittests for functions to add categorical AQI assignment to air quality data.
 """
 
 # Import packages
+import os
+import tempfile
 import unittest
 
+import numpy as np
 import pandas as pd
 
 import phoenix.code.data_cleaning as dc
+from phoenix.code import county_geometry as cg
 
 
 class TestDataCleaning(unittest.TestCase):
@@ -50,6 +54,109 @@ class TestDataCleaning(unittest.TestCase):
         with self.assertRaises(ValueError):
             dc.assign_aqicat(data)
 
+    def test_aqi_category(self):
+        """
+        Test for aqi_category.
+        Returns true if values are classified with the EPA thresholds
+        into a categorical, with NaN left missing.
+        """
+        pm25 = np.array([12.05, 12.1, 35.5, 55.5, 150.5, 250.5, np.nan])
+        categories = dc.aqi_category(pm25)
+
+        self.assertIsInstance(categories, pd.Categorical)
+        self.assertEqual(list(categories[:6]), dc.AQI_CATEGORIES)
+        self.assertTrue(pd.isna(categories[6]))
+
+    def test_aqi_value(self):
+        """
+        Test for aqi_value.
+        Returns true if the AQI is interpolated between breakpoints.
+        """
+        pm25 = np.array([0.0, 6.0, 12.0, 12.1, 35.49, 40.0, 600.0, np.nan])
+        aqi = dc.aqi_value(pm25)
+
+        np.testing.assert_array_equal(
+            aqi, [0, 25, 50, 51, 100, 112, 500, np.nan])
+
+    def test_impute_counties(self):
+        """
+        Test for impute_counties.
+        Returns true if every county without a station copies the
+        values of its donor county.
+        """
+        county_aq = pd.DataFrame({'Date': ['2020-08-01', '2020-08-02'],
+                                  'County': ['Washington', 'Lane'],
+                                  'Avg_PM2.5': [5.0, 9.0]})
+        donors = {'Clatsop': 'Washington', 'Polk': 'Washington'}
+        result = dc.impute_counties(county_aq, donors)
+
+        self.assertEqual(list(result.columns), list(county_aq.columns))
+        self.assertEqual(list(result['County']),
+                         ['Washington', 'Lane', 'Clatsop', 'Polk'])
+        self.assertEqual(list(result['Avg_PM2.5']), [5.0, 9.0, 5.0, 5.0])
+
+    def test_locate_stations(self):
+        """
+        Test for locate_stations.
+        Returns true if stations are assigned the county containing
+        them, and stations outside every county are dropped with a
+        warning.
+        """
+        square = [[[-124, 43], [-122, 43], [-122, 45], [-124, 45], [-124, 43]]]
+        geojson = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'altname': 'Lane'},
+             'geometry': {'type': 'Polygon', 'coordinates': square}}]}
+        county_index = cg.build_county_index(geojson, cell_size=0.5)
+
+        air_quality = pd.DataFrame({'Name': ['A', 'B', 'A'],
+                                    'Latitude': [44.0, 46.0, 44.0],
+                                    'Longitude': [-123.0, -123.0, -123.0]})
+
+        with self.assertWarns(UserWarning):
+            counties = dc.locate_stations(air_quality, county_index)
+
+        self.assertEqual(counties.to_dict('list'),
+                         {'Name': ['A'], 'County': ['Lane']})
+
+    def test_build_county_aq(self):
+        """
+        Test for build_county_aq.
+        Returns true if a rebuild after one station reading changes
+        re-aggregates only that date and matches a full build.
+        """
+        air_quality = pd.DataFrame({
+            'Date': ['2020-08-01', '2020-08-01', '2020-08-02'],
+            'Name': ['A', 'B', 'A'],
+            'Avg_PM2.5': [10.0, 20.0, 40.0]})
+        counties = pd.DataFrame({'Name': ['A', 'B'],
+                                 'County': ['Marion', 'Marion']})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            air_path = os.path.join(tmp, 'air.csv')
+            counties_path = os.path.join(tmp, 'counties.csv')
+            output_path = os.path.join(tmp, 'county_aq.csv')
+            full_path = os.path.join(tmp, 'full.csv')
+            air_quality.to_csv(air_path, index=False)
+            counties.to_csv(counties_path, index=False)
+
+            built = dc.build_county_aq(air_path, counties_path, output_path)
+            self.assertEqual(built, ['2020-08-01', '2020-08-02'])
+            self.assertEqual(
+                dc.build_county_aq(air_path, counties_path, output_path), [])
+
+            result = pd.read_csv(output_path)
+            self.assertEqual(list(result['Avg_PM2.5'][:2]), [15.0, 15.0])
+            self.assertEqual(list(result['County'][:2]), ['Marion', 'Polk'])
+
+            air_quality.loc[2, 'Avg_PM2.5'] = 60.0
+            air_quality.to_csv(air_path, index=False)
+            built = dc.build_county_aq(air_path, counties_path, output_path)
+            self.assertEqual(built, ['2020-08-02'])
+
+            dc.build_county_aq(air_path, counties_path, full_path)
+            self.assertTrue(pd.read_csv(output_path).equals(
+                pd.read_csv(full_path)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+"""
+Unittests for the locked and atomic file writing shared by processes.
+"""
+
+import os
+import tempfile
+import unittest
+
+import phoenix.code.file_io as fio
+
+
+class TestFileIO(unittest.TestCase):
+    """
+    Contains test cases for file_io.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'result.txt')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_atomic_file(self):
+        """
+        Test for atomic_file.
+        Returns true if a completed write replaces the file, and a
+        failed one keeps the old file and leaves no temporary file.
+        """
+        with fio.atomic_file(self.path, 'w') as result_file:
+            result_file.write('old')
+
+        with self.assertRaises(ValueError):
+            with fio.atomic_file(self.path, 'w') as result_file:
+                result_file.write('partial')
+                raise ValueError
+
+        with open(self.path) as result_file:
+            self.assertEqual(result_file.read(), 'old')
+        self.assertEqual(os.listdir(self.tmp.name), ['result.txt'])
+
+    def test_file_lock(self):
+        """
+        Test for file_lock.
+        Returns true if the lock is taken next to a path in a directory
+        that does not exist yet.
+        """
+        path = os.path.join(self.tmp.name, 'new', 'store')
+        with fio.file_lock(path):
+            self.assertTrue(os.path.exists(path + '.lock'))
+
+
+if __name__ == '__main__':
+    unittest.main()
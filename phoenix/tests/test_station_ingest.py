@@ -0,0 +1,78 @@
+"""
+Unittests for the streaming hourly-to-daily station ingestion.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import phoenix.code.station_ingest as si
+
+
+class TestStationIngest(unittest.TestCase):
+    """
+    Contains test cases for station_ingest.
+    """
+
+    def setUp(self):
+        hours = pd.date_range('2020-09-01', periods=48, freq='h')
+        self.hourly = pd.DataFrame({'Location_I': 11,
+                                    'Datetime': hours,
+                                    'PM2.5': np.arange(48, dtype=float)})
+        self.stations = pd.DataFrame({'Location_I': [11, 12],
+                                      'Name': ['Albany', 'Bend'],
+                                      'Latitude': [44.6, 44.0],
+                                      'Longitude': [-123.1, -121.3]})
+
+    def test_daily_averages(self):
+        """
+        Test for daily_averages.
+        Returns true if only complete days get an average, and every
+        station gets a row for every day.
+        """
+        records = self.hourly.drop(index=30)
+        state = si.ingest_hourly(si.empty_state(), records)
+        daily = si.daily_averages(state, self.stations)
+
+        self.assertEqual(list(daily.columns), si.DAILY_COLUMNS)
+        self.assertEqual(list(daily['Location_I']), [11, 11, 12, 12])
+        self.assertEqual(daily['Avg_PM2.5'][0], 11.5)
+        self.assertTrue(daily['Avg_PM2.5'][1:].isna().all())
+        self.assertEqual(daily['Category'][0], 'Good')
+
+    def test_ingest_incremental(self):
+        """
+        Test for ingest_hourly.
+        Returns true if batches of hours, including a repeated hour,
+        aggregate the same as a single batch.
+        """
+        state = si.empty_state()
+        for batch in (self.hourly[:30], self.hourly[20:40], self.hourly[40:]):
+            state = si.ingest_hourly(state, batch)
+        whole = si.ingest_hourly(si.empty_state(), self.hourly)
+
+        pd.testing.assert_frame_equal(state, whole)
+        self.assertEqual(list(state['Hours']), [24, 24])
+
+    def test_state_round_trip(self):
+        """
+        Test for save_state and load_state.
+        Returns true if stored aggregates can be appended to.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state')
+            self.assertEqual(len(si.load_state(path)), 0)
+
+            si.save_state(si.ingest_hourly(si.empty_state(),
+                                           self.hourly[:24]), path)
+            state = si.ingest_hourly(si.load_state(path), self.hourly[24:])
+
+        daily = si.daily_averages(state, self.stations[:1])
+        self.assertEqual(list(daily['Avg_PM2.5']), [11.5, 35.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Unittests for the two-tier memoization of app callbacks.
+"""
+
+import os
+import tempfile
+import unittest
+
+import phoenix.code.tiered_cache as tc
+
+
+class TestTieredCache(unittest.TestCase):
+    """
+    Contains test cases for tiered_cache.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def count_species(self, species, day):
+        """
+        Stand-in for a callback, recording its calls.
+        """
+        self.calls.append((species, day))
+        return len(species) + day
+
+    def test_canonical_key(self):
+        """
+        Test for canonical_key.
+        Returns true if lists in any order or with repeats give one key.
+        """
+        self.assertEqual(tc.canonical_key(['b', 'a', 'b']),
+                         tc.canonical_key(('a', 'b')))
+        self.assertEqual(tc.canonical_key({'day': 1, 'month': ['June']}),
+                         (('day', 1), ('month', ('June',))))
+
+    def test_memory_tier(self):
+        """
+        Test for tiered_memoize without a disk tier.
+        Returns true if reordered list arguments hit the cache, swapped
+        positional arguments do not, and the least recently used result
+        is evicted.
+        """
+        cached = tc.tiered_memoize(maxsize=2)(self.count_species)
+        positional = tc.tiered_memoize()(lambda first, second: first)
+
+        self.assertEqual(cached(['a', 'b'], 1), 3)
+        self.assertEqual(cached(['b', 'a'], 1), 3)
+        self.assertEqual((positional(1, 2), positional(2, 1)), (1, 2))
+        cached(['a'], 2)
+        cached(['a'], 3)
+        cached(['a', 'b'], 1)
+
+        self.assertEqual(self.calls, [(['a', 'b'], 1), (['a'], 2),
+                                      (['a'], 3), (['a', 'b'], 1)])
+
+    def test_disk_tier(self):
+        """
+        Test for tiered_memoize with a disk tier.
+        Returns true if a second process (a second wrapper) reads the
+        result from disk, and a new version recomputes it.
+        """
+        worker1 = tc.tiered_memoize(self.tmp.name)(self.count_species)
+        worker2 = tc.tiered_memoize(self.tmp.name)(self.count_species)
+        updated = tc.tiered_memoize(self.tmp.name, version='2')(
+            self.count_species)
+
+        worker1(['a'], 1)
+        self.assertEqual(worker2(['a'], 1), 2)
+        self.assertEqual(len(self.calls), 1)
+
+        updated(['a'], 1)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_unloadable_result(self):
+        """
+        Test for tiered_memoize with a disk tier written by older code.
+        Returns true if a result whose class no longer exists is
+        recomputed instead of raising.
+        """
+        tc.tiered_memoize(self.tmp.name)(self.count_species)(['a'], 1)
+        for directory, _, files in os.walk(self.tmp.name):
+            for entry in files:
+                with open(os.path.join(directory, entry), 'wb') as stale:
+                    stale.write(b'cphoenix.code.removed_module\nFigure\n.')
+
+        cached = tc.tiered_memoize(self.tmp.name)(self.count_species)
+        self.assertEqual(cached(['a'], 1), 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_popular_requests(self):
+        """
+        Test for popular_requests.
+        Returns true if logged requests are counted, most requested
+        first, warming is not counted, and the log is compacted.
+        """
+        cached = tc.tiered_memoize(self.tmp.name, log_requests=True)(
+            self.count_species)
+        for species in (['a'], ['b', 'a'], ['a', 'b'], ['a'], ['a']):
+            cached(species, 1)
+        cached.warm(['c'], 1)
+
+        self.assertEqual(tc.popular_requests(self.tmp.name, cached),
+                         [([['a'], 1], 3), ([['a', 'b'], 1], 2)])
+        self.assertEqual(tc.popular_requests(self.tmp.name, cached, top=1),
+                         [([['a'], 1], 3)])
+        with open(os.path.join(self.tmp.name, tc.REQUEST_LOG)) as log_file:
+            self.assertEqual(len(log_file.readlines()), 2)
+
+    def test_disk_pruning(self):
+        """
+        Test for the eviction of the disk tier.
+        Returns true if results of an old version are removed and the
+        least recently used results beyond the cap are evicted.
+        """
+        old = tc.tiered_memoize(self.tmp.name, version='1')(
+            self.count_species)
+        old(['a'], 1)
+
+        cached = tc.tiered_memoize(self.tmp.name, version='2',
+                                   max_disk_entries=2)(self.count_species)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+        for day in range(3):
+            cached(['a'], day)
+            # Backdates the new result to just after the earlier ones,
+            # so their use is ordered despite coarse file times.
+            result_dir = os.path.join(self.tmp.name,
+                                      os.listdir(self.tmp.name)[0])
+            for entry in os.listdir(result_dir):
+                path = os.path.join(result_dir, entry)
+                if os.path.getmtime(path) > 1000 + day:
+                    os.utime(path, (1000 + day, 1000 + day))
+
+        restarted = tc.tiered_memoize(self.tmp.name, version='2',
+                                      max_disk_entries=2)(self.count_species)
+        self.assertEqual(len(os.listdir(result_dir)), 2)
+
+        restarted(['a'], 2)
+        restarted(['a'], 0)
+        self.assertEqual(self.calls[-1], (['a'], 0))
+        self.assertEqual(len(self.calls), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()